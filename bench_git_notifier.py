@@ -0,0 +1,445 @@
+#! /usr/bin/env python
+#
+# Benchmarks for git-notifier. Each scenario builds scratch repositories of
+# growing size and prints one JSON object per measurement, e.g.:
+#
+#     python bench_git_notifier.py [scenario ...] >bench_output.txt
+#
+# The "push" scenario replays complete hook runs; it takes an optional custom
+# repository shape, e.g.:
+#
+#     python bench_git_notifier.py push commits=5000 branches=200 push=20
+
+import asyncore
+import json
+import os
+import re
+import shutil
+import smtpd
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import git_notifier
+
+Popen = subprocess.Popen
+
+class CountingPopen(Popen):
+    """ Counts the child processes started. """
+
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.count += 1
+        Popen.__init__(self, *args, **kwargs)
+
+subprocess.Popen = CountingPopen
+
+class Repo(object):
+    """ Scratch repository filled via git fast-import. """
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="git-notifier-bench-")
+        self.when = 1300000000
+        subprocess.check_call(["git", "init", "-q", "--bare", self.dir])
+
+    def fastImport(self, commands):
+        child = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=self.dir, stdin=subprocess.PIPE)
+        child.communicate("".join(commands))
+        assert child.returncode == 0
+
+    # Returns fast-import commands creating a commit on *ref* that sets the
+    # given files, with *parents* being marks or revisions.
+    def commit(self, ref, mark, parents, files):
+        self.when += 1
+        msg = "commit %d\n" % mark
+        cmds = ["commit %s\nmark :%d\n" % (ref, mark),
+                "committer Bench <bench@example.com> %d +0000\n" % self.when,
+                "data %d\n%s" % (len(msg), msg)]
+
+        if parents:
+            cmds.append("from %s\n" % parents[0])
+
+        for parent in parents[1:]:
+            cmds.append("merge %s\n" % parent)
+
+        for (name, data) in files:
+            cmds.append("M 644 inline %s\ndata %d\n%s\n" % (name, len(data), data))
+
+        return cmds
+
+    def build(self, commits=1, tags=0, branches=0):
+        cmds = []
+
+        for i in range(1, commits + 1):
+            parents = (i > 1) and [":%d" % (i - 1)] or []
+            cmds += self.commit("refs/heads/master", i, parents, [("file", "change %d\n" % i)])
+
+        for i in range(tags):
+            cmds.append("tag release-%d\nfrom :%d\n" % (i, commits))
+            cmds.append("tagger Bench <bench@example.com> %d +0000\n" % self.when)
+            cmds.append("data 4\ntag\n\n")
+
+        for i in range(branches):
+            cmds += self.commit("refs/heads/branch-%d" % i, commits + i + 1, [":%d" % commits],
+                                [("branch-%d" % i, "branch %d\n" % i)])
+
+        self.fastImport(cmds)
+        return self
+
+    # Adds new history on top of master: *commits* plain commits, then
+    # *merges* topic branches each merged back, then a commit adding a file
+    # of *diffkb* KB. Returns the ref updates as a post-receive hook sees them.
+    def push(self, commits=0, merges=0, diffkb=0):
+        before = self.refs()
+        tip = before["refs/heads/master"]
+        cmds = []
+        mark = 0
+
+        for i in range(commits):
+            mark += 1
+            cmds += self.commit("refs/heads/master", mark, [tip], [("file", "pushed %d\n" % mark)])
+            tip = ":%d" % mark
+
+        for i in range(merges):
+            mark += 2
+            cmds += self.commit("refs/heads/topic-%d" % i, mark - 1, [tip], [("topic-%d" % i, "topic\n")])
+            cmds += self.commit("refs/heads/master", mark, [tip, ":%d" % (mark - 1)], [])
+            tip = ":%d" % mark
+
+        if diffkb:
+            lines = ["line %d of a large generated file\n" % i for i in range(diffkb * 1024 // 32)]
+            cmds += self.commit("refs/heads/master", mark + 1, [tip], [("big", "".join(lines))])
+
+        self.fastImport(cmds)
+        after = self.refs()
+
+        return [(before.get(ref, Zero), rev, ref) for (ref, rev) in sorted(after.items())
+                if before.get(ref) != rev]
+
+    def refs(self):
+        out = subprocess.check_output(["git", "for-each-ref", "--format=%(refname) %(objectname)"], cwd=self.dir)
+        return dict(line.split() for line in out.splitlines())
+
+    def remove(self):
+        shutil.rmtree(self.dir)
+
+Zero = "0" * 40
+
+class SMTPSink(smtpd.SMTPServer):
+    """ Local SMTP server that accepts and counts mails. """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.sessions = 0
+        self.messages = 0
+        self.bytes = 0
+
+        thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def handle_accept(self):
+        self.sessions += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+        self.bytes += len(data)
+
+# Runs func() inside the repository, returning wall time and processes started.
+def measure(repo, func):
+    cwd = os.getcwd()
+    os.chdir(repo.dir)
+
+    try:
+        CountingPopen.count = 0
+        start = time.time()
+        func()
+        return {"seconds": round(time.time() - start, 4), "subprocesses": CountingPopen.count}
+    finally:
+        os.chdir(cwd)
+
+def report(scenario, params, result):
+    result = dict(result)
+    result["scenario"] = scenario
+    result.update(params)
+    print json.dumps(result, sort_keys=True)
+    sys.stdout.flush()
+
+def bench_tags():
+    """ State.getCurrent() with a growing number of annotated tags. """
+    for tags in (10, 100, 1000, 10000):
+        repo = Repo().build(commits=10, tags=tags)
+        report("tags", {"tags": tags}, measure(repo, git_notifier.State.getCurrent))
+        repo.remove()
+
+def bench_smtp():
+    """ Mailer.send() with and without reusing the SMTP session. """
+    git_notifier.Config = git_notifier.GitNotifierConfig(None)
+    git_notifier.Config.log = open(os.devnull, "w")
+
+    sink = SMTPSink()
+    message = "Subject: test\n\n" + "x" * 4096
+    count = 200
+
+    for max_messages in (1, 10, 100):
+        sink.sessions = 0
+        mailer = git_notifier.Mailer("127.0.0.1", sink.port, "bench@example.com", "",
+                                     ["sink@example.com"], max_messages=max_messages)
+        start = time.time()
+
+        for i in range(count):
+            mailer.send(mailer.sender, mailer.recipients, message)
+
+        mailer.close()
+        seconds = time.time() - start
+        report("smtp", {"messages": count, "max_messages": max_messages},
+               {"seconds": round(seconds, 4), "ms_per_message": round(seconds * 1000 / count, 3),
+                "sessions": sink.sessions})
+
+    sink.close()
+
+# Renders a diff file to /dev/null in a fresh process, either streamed or read
+# into a string first, printing the process' peak RSS in KB.
+HtmlChild = """
+import resource, sys, git_notifier
+(mode, path) = sys.argv[1:]
+out = open("/dev/null", "w")
+if mode == "stream":
+    for chunk in git_notifier.iterPatch2html(open(path)):
+        out.write(chunk)
+else:
+    out.write(git_notifier.patch2html(open(path).read()))
+print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+def bench_html():
+    """ Peak memory of rendering growing diffs to HTML. """
+    hunk = "@@ -1,3 +1,3 @@\n context <a> & <b>\n-old line %d\n+new line %d\n"
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    for megabytes in (1, 4, 16, 64):
+        (fd, path) = tempfile.mkstemp(prefix="git-notifier-bench-")
+        out = os.fdopen(fd, "w")
+        out.write("diff --git a/file b/file\n--- a/file\n+++ b/file\n")
+        i = 0
+
+        while out.tell() < megabytes * 1024 * 1024:
+            out.write(hunk % (i, i))
+            i += 1
+
+        out.close()
+
+        for mode in ("stream", "string"):
+            start = time.time()
+            output = subprocess.check_output([sys.executable, "-c", HtmlChild, mode, path], cwd=here)
+            report("html", {"megabytes": megabytes, "mode": mode},
+                   {"seconds": round(time.time() - start, 4), "max_rss_kb": int(output)})
+
+        os.unlink(path)
+
+def bench_intraline():
+    """ Worst-case cost of word highlighting per hunk, against plain difflib. """
+    import difflib
+    import random
+
+    rnd = random.Random(1)
+    words = lambda count: ["w%d" % rnd.randint(0, 50) for i in range(count)]
+
+    for size in (1000, 10000, 100000):
+        minified = words(size)
+        changed = list(minified)
+        changed[size // 2] = "changed"
+        spread = [(i % 7 and word or "x") for (i, word) in enumerate(minified)]
+
+        cases = [("minified", [" ".join(minified)], [" ".join(changed)]),
+                 ("scattered", [" ".join(minified)], [" ".join(spread)]),
+                 ("disjoint", [" ".join(words(size))], [" ".join(words(size))]),
+                 ("many-lines", [" ".join(words(20)) for i in range(size // 20)],
+                                [" ".join(words(20)) for i in range(size // 20)])]
+
+        for (name, removed, added) in cases:
+            highlighter = git_notifier.HunkHighlighter()
+            start = time.time()
+
+            for line in removed:
+                highlighter.add("-" + line)
+
+            for line in added:
+                highlighter.add("+" + line)
+
+            highlighter.flush()
+            result = {"seconds": round(time.time() - start, 4)}
+
+            if size <= 1000:
+                # Character-level, as naive highlighting would do. Beyond
+                # this size, it takes minutes.
+                start = time.time()
+
+                for (old, new) in zip(removed, added):
+                    difflib.SequenceMatcher(None, old, new, False).get_opcodes()
+
+                result["difflib_seconds"] = round(time.time() - start, 4)
+
+            report("intraline", {"case": name, "words": size}, result)
+
+def bench_startup():
+    """ Configuration loading and a complete hook run for a no-op push. """
+    repo = Repo().build(commits=10)
+    script = os.path.splitext(git_notifier.__file__)[0] + ".py"
+    settings = [("smtp-host", "127.0.0.1"), ("mailinglist", "list@example.com"),
+                ("emailprefix", "[bench]"), ("maxdiffsize", "2048"), ("parallel", "2")]
+
+    for (name, value) in settings:
+        subprocess.check_call(["git", "config", "hooks.%s" % name, value], cwd=repo.dir)
+
+    def load():
+        config = git_notifier.GitNotifierConfig(git_notifier.GitConfigProvider())
+        config.parseArgs([])
+        config.get_config_variables()
+
+    report("startup", {"phase": "config"}, measure(repo, load))
+
+    hook = [sys.executable, script, "--log", os.devnull]
+    subprocess.check_call(hook + ["--updateonly"], cwd=repo.dir)
+    runs = []
+
+    for i in range(5):
+        start = time.time()
+        subprocess.check_call(hook, cwd=repo.dir, stdin=open(os.devnull))
+        runs.append(time.time() - start)
+
+    report("startup", {"phase": "hook"}, {"seconds": round(sorted(runs)[len(runs) // 2], 4)})
+    repo.remove()
+
+# Runs git-notifier as a post-receive hook in a fresh process, counting the
+# processes it starts and skipping, but recording, the pauses between mails.
+# Writes JSON statistics to the file given as first argument.
+HookChild = """
+import json, resource, runpy, subprocess, sys, time
+stats = {"subprocesses": 0, "paused_seconds": 0}
+Popen = subprocess.Popen
+class CountingPopen(Popen):
+    def __init__(self, *args, **kwargs):
+        stats["subprocesses"] += 1
+        Popen.__init__(self, *args, **kwargs)
+def sleep(seconds):
+    stats["paused_seconds"] += seconds
+subprocess.Popen = CountingPopen
+time.sleep = sleep
+(out, script) = sys.argv[1:3]
+sys.argv = [script] + sys.argv[3:]
+try:
+    runpy.run_path(script, run_name="__main__")
+finally:
+    stats["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stats["git_max_rss_kb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    json.dump(stats, open(out, "w"))
+"""
+
+# Runs the hook inside the repository with *updates* on stdin, returning wall
+# time, processes started, peak RSS, and the number and size of mails sent.
+# With --debug among *args*, the mails are counted from the hook's output
+# rather than from the SMTP sink.
+def replay(repo, updates, args, sink):
+    script = os.path.splitext(os.path.abspath(git_notifier.__file__))[0] + ".py"
+    (fd, stats) = tempfile.mkstemp(prefix="git-notifier-bench-")
+    os.close(fd)
+
+    (sink.messages, sink.bytes) = (0, 0)
+    start = time.time()
+    child = subprocess.Popen([sys.executable, "-c", HookChild, stats, script] + args, cwd=repo.dir,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+    (out, err) = child.communicate("".join("%s %s %s\n" % update for update in updates))
+    seconds = time.time() - start
+    assert child.returncode == 0
+
+    result = json.load(open(stats))
+    os.unlink(stats)
+
+    result["seconds"] = round(seconds, 4)
+    result["paused_seconds"] = round(result["paused_seconds"], 4)
+
+    if "--debug" in args:
+        result["mails"] = len(re.findall(r"^Subject: ", out, re.M))
+        result["bytes_sent"] = len(out)
+    else:
+        result["mails"] = sink.messages
+        result["bytes_sent"] = sink.bytes
+
+    return result
+
+# Repository shapes replayed by bench_push(). "commits", "branches", and "tags"
+# shape the existing history; "push", "merges", and "diffkb" the pushed one.
+# Command line arguments of the form key=value replace these with one shape.
+PushShapes = [
+    {"commits": 1000},
+    {"commits": 10000},
+    {"branches": 100},
+    {"branches": 1000},
+    {"tags": 100},
+    {"tags": 1000},
+    {"push": 0, "merges": 10},
+    {"push": 0, "merges": 50},
+    {"push": 1, "diffkb": 1024},
+    {"push": 1, "diffkb": 16384},
+    {"push": 1000},
+]
+
+PushDefaults = {"commits": 100, "branches": 0, "tags": 0, "push": 10, "merges": 0, "diffkb": 0, "debug": 0}
+
+def bench_push():
+    """ Complete post-receive runs for pushes into repositories of various shapes. """
+    sink = SMTPSink()
+    state = [git_notifier.CacheFile, git_notifier.CacheFile + ".journal"]
+
+    for params in PushShapes:
+        shape = dict(PushDefaults)
+        shape.update(params)
+
+        repo = Repo().build(commits=shape["commits"], tags=shape["tags"], branches=shape["branches"])
+
+        for (name, value) in [("smtp-host", "127.0.0.1"), ("smtp-port", str(sink.port)),
+                              ("mailinglist", "list@example.com")]:
+            subprocess.check_call(["git", "config", "hooks.%s" % name, value], cwd=repo.dir)
+
+        args = ["--log", os.devnull] + (shape["debug"] and ["--debug"] or [])
+        replay(repo, [], args + ["--updateonly"], sink)
+
+        for file in state:
+            if os.path.exists(os.path.join(repo.dir, file)):
+                shutil.copy(os.path.join(repo.dir, file), os.path.join(repo.dir, file + ".bench"))
+
+        updates = repo.push(commits=shape["push"], merges=shape["merges"], diffkb=shape["diffkb"])
+
+        for mode in ("full", "incremental"):
+            # Starts each mode from the state before the push.
+            for file in state:
+                if os.path.exists(os.path.join(repo.dir, file + ".bench")):
+                    shutil.copy(os.path.join(repo.dir, file + ".bench"), os.path.join(repo.dir, file))
+
+            shutil.rmtree(os.path.join(repo.dir, git_notifier.RenderCacheDir), True)
+
+            flags = (mode == "incremental") and ["--incremental"] or []
+            report("push", dict(shape, mode=mode), replay(repo, updates, args + flags, sink))
+
+        repo.remove()
+
+    sink.close()
+
+Scenarios = [(name[6:], func) for (name, func) in sorted(globals().items()) if name.startswith("bench_")]
+
+if __name__ == "__main__":
+    selected = [arg for arg in sys.argv[1:] if "=" not in arg]
+    shape = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+
+    if shape:
+        PushShapes = [dict((key, int(value)) for (key, value) in shape.items())]
+
+    for (name, func) in Scenarios:
+        if not selected or name in selected:
+            func()
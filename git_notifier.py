@@ -1,7 +1,20 @@
 #! /usr/bin/env python
 
+import atexit
+import binascii
+import cgi
+import cProfile
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
+import multiprocessing
 import optparse
 import os
+import pstats
 import shutil
 import socket
 import sys
@@ -9,10 +22,16 @@ import subprocess
 import tempfile
 import time
 import re
+import shlex
 import smtplib
+import struct
+import threading
 from cStringIO import StringIO
+from email import Encoders
+from email.MIMEBase import MIMEBase
 from email.MIMEText import MIMEText
 from email.MIMEMultipart import MIMEMultipart
+from email.Utils import formatdate, getaddresses
 
 VERSION   = "0.3-13"  # Filled in automatically.
 
@@ -21,25 +40,41 @@ CacheFile = ".%s.dat" % Name
 Separator = "\n>---------------------------------------------------------------\n"
 NoDiff    = "[nodiff]"
 NoMail    = "[nomail]"
+ZeroRev   = "0" * 40
+
+# Header of the binary state file: magic, length of the text section holding
+# heads, tags and diffs, and number of 20-byte revisions following it.
+StateMagic  = "GNS\x01"
+StateHeader = struct.Struct("!4sII")
+LockFile    = ".%s.lock" % Name
 
 gitolite = "GL_USER" in os.environ
 whoami = os.environ["LOGNAME"]
 sender = gitolite and os.environ["GL_USER"] or whoami
 
 Config = None
+mailer = None
 
 class Mailer(object):
+    """ Delivers mails over one SMTP session kept open across sends. The
+    session is re-established if the server drops it, and after
+    *max_messages* mails. """
+
+    DefaultMaxMessages = 100
+
     def __init__(self, smtp_host, smtp_port,
-                 sender, sender_password, recipients,ssl=False):
+                 sender, sender_password, recipients,ssl=False, max_messages=None):
         self.smtp_host = smtp_host
         self.smtp_port = smtp_port
         self.sender = sender
         self.sender_password = sender_password
         self.recipients = recipients
         self.ssl = ssl
+        self.max_messages = int(max_messages or self.DefaultMaxMessages)
+        self.server = None
+        self.sent = 0 # Over the current session.
 
-    def send(self, sender, recipients, message):
-        
+    def connect(self):
         server = smtplib.SMTP(self.smtp_host, self.smtp_port)
         if self.ssl:
             server.ehlo()
@@ -47,36 +82,92 @@ class Mailer(object):
             server.ehlo()
             server.login(self.sender, self.sender_password)
 
-        log("Sending email to %s " % self.recipients)
-        server.sendmail(self.sender, self.recipients, message)
-        server.quit()
+        self.server = server
+        self.sent = 0
+
+    def send(self, sender, recipients, message):
+        if self.server and self.sent >= self.max_messages:
+            self.close()
+
+        log("Sending email to %s " % ", ".join(recipients))
+
+        with phase("smtp") as p:
+            p.bytes += len(message)
+            self._send(recipients, message)
+
+    def _send(self, recipients, message):
+        for retry in (False, True):
+            if not self.server:
+                self.connect()
+
+            try:
+                self.server.sendmail(self.sender, recipients, message)
+                self.sent += 1
+                return
+
+            except (smtplib.SMTPServerDisconnected, socket.error), e:
+                self.server = None
+
+                if retry:
+                    raise
+
+                log("SMTP session lost (%s), reconnecting" % e)
+
+    def close(self):
+        if not self.server:
+            return
+
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+        self.server = None
 
 class Hunk(object):
-  """ Parses hunks starting with @@ -R +R @@ """
+  """ Hunk starting with @@ -R +R @@, kept as offsets into the diff text. """
 
-  def __init__(self):
-    self.start_src=None 
+  def __init__(self, buffer="", start=0):
+    self.buffer=buffer
+    self.start=start # Offset of the "@@" line.
+    self.end=start   # Offset just past the last line.
+    self.start_src=None
     self.lines_src=None
     self.start_tgt=None
     self.lines_tgt=None
     self.invalid=False
-    self.text=[]
 
-  def append(self, line):
-      self.text.append(line)
+  @property
+  def text(self):
+      return str(self).split('\n')
 
   def __str__(self):
-      return '\n'.join(self.text)      
+      return self.buffer[self.start:self.end].rstrip('\n')
 
 class Patch(object):
-
-  def __init__(self):
-    self.source = None 
-    self.target = None
+  """ Changes to one file, kept as offsets into the diff text. """
+
+  def __init__(self, buffer="", start=0):
+    self.buffer = buffer
+    self.start = start # Offset of the "diff" line.
+    self.end = start   # Offset just past the last line.
+    self.source = None # None for added files.
+    self.target = None # None for deleted files.
     self.hunks = []
-    self.hunkends = []
-    self.header = []
-    self.type = None
+    self.type = "modify" # Or "add", "delete", "rename", "copy", "binary".
+
+  @property
+  def path(self):
+      return self.target or self.source
+
+  @property
+  def header(self):
+      # Lines before the first hunk.
+      end = self.hunks and self.hunks[0].start or self.end
+      return self.buffer[self.start:end].rstrip('\n').split('\n')
+
+  def size(self):
+      return self.end - self.start
 
 CSSFILE_TEMPLATE = '''\
 td.linenos { background-color: #f0f0f0; padding-right: 10px; }
@@ -87,6 +178,8 @@ body .ge { font-style: italic }
 body .gr { color: #aa0000 }
 body .gh { color: #999999 }
 body .gi { color: #000000; background-color: #ddffdd }
+body .gd .x { background-color: #ffaaaa }
+body .gi .x { background-color: #aaffaa }
 '''
 
 DOC_HEADER = '''\
@@ -112,50 +205,391 @@ DOC_FOOTER = '''\
 </html>
 '''
 
+HunkHeader = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
 class GitDiffParser(object):
+    """ Splits a unified diff as produced by git into per-file patches. Hunks
+    end after as many lines as their header announces. Anything before the
+    first "diff" line, like a diffstat, is skipped. """
+
     def __init__(self):
         pass
 
     def parse(self, difftxt):
-        state = 'toplevel'
-        hunks = []
-        new_hunk = None 
-        for line in difftxt.split('\n'):
-            if state == 'toplevel':
-                if line.startswith("@@"):
-                    state = 'hunk'
-                    new_hunk = Hunk()
-
-            if state == 'hunk':
-                if line.startswith("\ No newline at end of file"):
-                    state='toplevel'
-                    hunks.append(new_hunk)
-                    new_hunk = None 
-                else:
-                    new_hunk.append(line)
-        if not (new_hunk is None):
-            hunks.append(new_hunk) 
-        return hunks
+        # Returns the hunks of all files.
+        return [hunk for patch in self.patches(difftxt) for hunk in patch.hunks]
+
+    def patches(self, difftxt):
+        patches = []
+        patch = None
+        hunk = None
+        (src, tgt) = (0, 0) # Lines still expected for the current hunk.
+        pos = 0
+
+        while pos < len(difftxt):
+            nl = difftxt.find("\n", pos)
+            end = (nl < 0) and len(difftxt) or nl + 1
+            line = difftxt[pos:end].rstrip("\n")
+
+            if hunk:
+                if hunkContinues(line, src, tgt):
+                    (src, tgt) = hunkCount(line, src, tgt)
+                    (hunk.end, patch.end, pos) = (end, end, end)
+                    continue
+
+                hunk = None
+
+            if line.startswith("diff "):
+                patch = self._startPatch(difftxt, pos, line)
+                patches.append(patch)
+
+            elif line.startswith("@@"):
+                if not patch:
+                    patch = Patch(difftxt, pos)
+                    patches.append(patch)
+
+                hunk = self._startHunk(difftxt, pos, line)
+                patch.hunks.append(hunk)
+                (src, tgt) = (hunk.lines_src, hunk.lines_tgt)
+
+            elif patch and not patch.hunks:
+                self._parseHeader(patch, line)
+
+            else:
+                # Outside of any file.
+                patch = None
+                pos = end
+                continue
+
+            patch.end = end
+            pos = end
+
+        return patches
+
+    def _startPatch(self, difftxt, pos, line):
+        patch = Patch(difftxt, pos)
+        m = re.match(r"^diff --git a/(.*) b/(.*)$", line)
+
+        if m:
+            (patch.source, patch.target) = (m.group(1), m.group(2))
+
+        return patch
+
+    def _startHunk(self, difftxt, pos, line):
+        hunk = Hunk(difftxt, pos)
+        ranges = hunkRanges(line)
+
+        if not ranges:
+            # E.g., a combined diff. Takes all lines that look like changes.
+            hunk.invalid = True
+            return hunk
+
+        (hunk.start_src, hunk.lines_src, hunk.start_tgt, hunk.lines_tgt) = ranges
+        return hunk
+
+    def _parseHeader(self, patch, line):
+        (key, sep, value) = line.partition(" ")
+
+        if line.startswith("--- "):
+            patch.source = self._path(line[4:], "a/")
+
+        elif line.startswith("+++ "):
+            patch.target = self._path(line[4:], "b/")
+
+        elif line.startswith("new file mode"):
+            (patch.type, patch.source) = ("add", None)
+
+        elif line.startswith("deleted file mode"):
+            (patch.type, patch.target) = ("delete", None)
+
+        elif line.startswith("rename from ") or line.startswith("copy from "):
+            patch.type = key
+            patch.source = value.partition(" ")[2]
+
+        elif line.startswith("rename to ") or line.startswith("copy to "):
+            patch.target = value.partition(" ")[2]
+
+        elif line.startswith("Binary files "):
+            patch.type = "binary"
+
+    def _path(self, name, prefix):
+        name = name.rstrip("\t")
+
+        if name == "/dev/null":
+            return None
+
+        if name.startswith(prefix):
+            return name[len(prefix):]
+
+        return name
 
 def patch2html(patch, title='No title set', heads=''):
+    if isinstance(patch, basestring):
+        patch = StringIO(patch)
+
     html = StringIO()
-    parser = GitDiffParser()
-    html.write(DOC_HEADER % locals())
-    hucks = parser.parse(patch)
-    for h in hucks:
-        html.write("<pre><div>")
-        for line in h.text:
-            if line.startswith("-"):
-                html.write('<span class="gd">'+ line + "</span>\n")
-            elif line.startswith("+"):
-                html.write('<span class="gi">'+ line +"</span>\n")
-            else:
-                html.write('<span class="gh">'+ line +"</span>\n")
-        html.write("</div></pre>")
 
-    html.write(DOC_FOOTER)
+    for chunk in iterPatch2html(patch, title=title, heads=heads):
+        html.write(chunk)
+
     return html.getvalue()
 
+# Yields the HTML for a diff chunk by chunk. The diff can be any iterable of
+# lines, such as a file or the output of gitStream(), and is consumed one line
+# at a time.
+def iterPatch2html(lines, title='No title set', heads=''):
+    yield htmlHeader(title, heads)
+
+    for chunk in iterHunks2html(lines):
+        yield chunk
+
+def htmlHeader(title, heads):
+    return DOC_HEADER % {"title": cgi.escape(title), "heads": cgi.escape(heads)}
+
+# Like iterPatch2html(), but without the header, which is the only part that
+# depends on more than the diff.
+def iterHunks2html(lines):
+    hunk = None
+    (src, tgt) = (0, 0) # Lines still expected for the current hunk.
+
+    for line in lines:
+        line = line.rstrip("\n")
+
+        if hunk and not hunkContinues(line, src, tgt):
+            for chunk in hunk.flush():
+                yield chunk
+
+            hunk = None
+            yield "</div></pre>"
+
+        if not hunk:
+            if not line.startswith("@@"):
+                continue
+
+            ranges = hunkRanges(line)
+            (src, tgt) = ranges and (ranges[1], ranges[3]) or (None, None)
+            hunk = HunkHighlighter()
+            yield "<pre><div>"
+
+        else:
+            (src, tgt) = hunkCount(line, src, tgt)
+
+        for chunk in hunk.add(line):
+            yield chunk
+
+    if hunk:
+        for chunk in hunk.flush():
+            yield chunk
+
+        yield "</div></pre>"
+
+    yield DOC_FOOTER
+
+# Returns start and length of the source and target ranges of a hunk header
+# line, or None if it isn't one of a plain unified diff.
+def hunkRanges(line):
+    m = HunkHeader.match(line)
+    if not m:
+        return None
+
+    count = lambda n: n is None and 1 or int(n)
+    return (int(m.group(1)), count(m.group(2)), int(m.group(3)), count(m.group(4)))
+
+# Tells whether a diff line belongs to the hunk that expects *src* and *tgt*
+# more lines. For hunks with unknown ranges (None), anything that looks like a
+# change does.
+def hunkContinues(line, src, tgt):
+    if line.startswith("\\"):
+        # "\ No newline at end of file" refers to the line before.
+        return True
+
+    if src is None:
+        return line[:1] in (" ", "-", "+")
+
+    return (src > 0 or tgt > 0) and line[:1] in (" ", "-", "+", "")
+
+# Returns the numbers of source and target lines a hunk still expects after
+# *line*.
+def hunkCount(line, src, tgt):
+    if src is None:
+        return (src, tgt)
+
+    if line[:1] in (" ", "-", ""):
+        src -= 1
+
+    if line[:1] in (" ", "+", ""):
+        tgt -= 1
+
+    return (src, tgt)
+
+IntralineBudget   = 20000 # Steps of word diffing per hunk.
+IntralineMaxBlock = 100   # Changed lines buffered for pairing.
+IntralineWords    = re.compile(r"\w+|\s+|[^\w\s]")
+
+class HunkHighlighter(object):
+    """ Renders the lines of a hunk. Runs of removed lines directly followed
+    by added ones are paired up, and the words that differ within each pair
+    get highlighted. The work per hunk is bounded by IntralineBudget; once
+    that is used up, changed lines are highlighted as a whole. """
+
+    def __init__(self, budget=None):
+        self.budget = budget is None and IntralineBudget or budget
+        self.removed = []
+        self.added = []
+
+    def add(self, line):
+        # Returns the HTML for any lines now complete.
+        if line.startswith("-"):
+            chunks = self.added and self.flush() or []
+            self.removed.append(line)
+
+        elif line.startswith("+"):
+            chunks = []
+            self.added.append(line)
+
+        else:
+            return self.flush() + [htmlLine("gh", line)]
+
+        if len(self.removed) + len(self.added) > IntralineMaxBlock:
+            self.budget = 0
+            chunks += self.flush()
+
+        return chunks
+
+    def flush(self):
+        pairs = [self.highlight(old, new) for (old, new) in zip(self.removed, self.added)]
+        chunks = [old for (old, new) in pairs]
+        chunks += [htmlLine("gd", line) for line in self.removed[len(pairs):]]
+        chunks += [new for (old, new) in pairs]
+        chunks += [htmlLine("gi", line) for line in self.added[len(pairs):]]
+
+        self.removed = []
+        self.added = []
+        return chunks
+
+    def highlight(self, old, new):
+        # Returns the HTML for a removed and an added line.
+        if len(old) + len(new) > self.budget:
+            # Not even worth splitting into words.
+            self.budget = 0
+            return (htmlLine("gd", old), htmlLine("gi", new))
+
+        changes = None
+        a = IntralineWords.findall(old[1:])
+        b = IntralineWords.findall(new[1:])
+        self.budget -= len(a) + len(b)
+
+        if self.budget > 0:
+            result = diffWords(a, b, self.budget)
+
+            if result:
+                (changes, cost) = result
+                self.budget -= cost
+
+        if changes and len(changes[0]) < len(a) and len(changes[1]) < len(b):
+            return (htmlLine("gd", old, a, changes[0]), htmlLine("gi", new, b, changes[1]))
+
+        # Out of budget, or nothing in common.
+        return (htmlLine("gd", old), htmlLine("gi", new))
+
+# Returns the HTML for a diff line, with the given words of its content
+# marked as changed.
+def htmlLine(css, line, words=None, changed=None):
+    if not changed:
+        return '<span class="%s">%s</span>\n' % (css, cgi.escape(line))
+
+    out = [line[:1]]
+    marked = False
+
+    for (i, word) in enumerate(words):
+        if (i in changed) != marked:
+            out.append(marked and "</span>" or '<span class="x">')
+            marked = not marked
+
+        out.append(cgi.escape(word))
+
+    if marked:
+        out.append("</span>")
+
+    return '<span class="%s">%s</span>\n' % (css, "".join(out))
+
+# Computes a shortest edit script between two word lists with Myers'
+# algorithm, giving up once it takes more than *budget* steps. Returns the
+# sets of indices of words removed from *a* and added in *b*, plus the steps
+# taken; or None if over budget.
+def diffWords(a, b, budget):
+    # Common prefix and suffix are cheap to strip, and often all that's
+    # needed for lines with small changes.
+    (n, m) = (len(a), len(b))
+    prefix = 0
+
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+
+    suffix = 0
+
+    while suffix < n - prefix and suffix < m - prefix and a[n - suffix - 1] == b[m - suffix - 1]:
+        suffix += 1
+
+    cost = prefix + suffix
+    (a, b) = (a[prefix:n - suffix], b[prefix:m - suffix])
+    (n, m) = (len(a), len(b))
+
+    v = {1: 0}
+    trace = []
+
+    for d in xrange(n + m + 1):
+        trace.append(dict(v))
+        cost += len(v)
+
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+
+            y = x - k
+
+            while x < n and y < m and a[x] == b[y]:
+                (x, y) = (x + 1, y + 1)
+                cost += 1
+
+            v[k] = x
+            cost += 1
+
+            if cost > budget:
+                return None
+
+            if x >= n and y >= m:
+                removed = set()
+                added = set()
+
+                # Walks back through the snapshots to collect the edits.
+                for e in xrange(len(trace) - 1, 0, -1):
+                    v = trace[e]
+                    k = x - y
+
+                    if k == -e or (k != e and v[k - 1] < v[k + 1]):
+                        k += 1
+                    else:
+                        k -= 1
+
+                    (px, py) = (v[k], v[k] - k)
+
+                    while x > px and y > py:
+                        (x, y) = (x - 1, y - 1)
+
+                    if x == px:
+                        added.add(py + prefix)
+                    else:
+                        removed.add(px + prefix)
+
+                    (x, y) = (px, py)
+
+                return ((removed, added), cost)
+
+    return None
+
 class GitReport(object):
 
     def __init__(self):
@@ -165,366 +599,2144 @@ class GitReport(object):
         pass
     
 #-------------------------------------------------------------------------------
+class RevisionStore(object):
+    """ Set of revisions backed by a sorted array of binary SHA1s, typically a
+    memory-mapped part of the state file. Lookups are binary searches;
+    additions and removals are kept in memory on top of the array. """
+
+    def __init__(self, data="", offset=0, count=0):
+        self._data = data
+        self._offset = offset
+        self._count = count
+        self._added = set()   # Not in the array.
+        self._removed = set() # In the array.
+
+    def _find(self, rev):
+        sha = binascii.unhexlify(rev)
+        (lo, hi) = (0, self._count)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._offset + mid * 20
+            cur = self._data[start:start + 20]
+
+            if cur == sha:
+                return True
+            elif cur < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return False
+
+    def _iterBinary(self):
+        for i in xrange(self._count):
+            start = self._offset + i * 20
+            yield self._data[start:start + 20]
+
+    def __contains__(self, rev):
+        if rev in self._added:
+            return True
+
+        if rev in self._removed:
+            return False
+
+        return self._find(rev)
+
+    def __iter__(self):
+        for sha in self._iterBinary():
+            rev = binascii.hexlify(sha)
+            if rev not in self._removed:
+                yield rev
+
+        for rev in self._added:
+            yield rev
+
+    def __len__(self):
+        return self._count - len(self._removed) + len(self._added)
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def add(self, rev):
+        if rev in self._removed:
+            self._removed.remove(rev)
+
+        elif not self._find(rev):
+            self._added.add(rev)
+
+    def discard(self, rev):
+        if rev in self._added:
+            self._added.remove(rev)
+
+        elif self._find(rev):
+            self._removed.add(rev)
+
+    def update(self, revs):
+        for rev in revs:
+            self.add(rev)
+
+    def difference_update(self, revs):
+        for rev in revs:
+            self.discard(rev)
+
+    def copy(self):
+        store = RevisionStore(self._data, self._offset, self._count)
+        store._added = set(self._added)
+        store._removed = set(self._removed)
+        return store
+
+    def sortedBinary(self):
+        # Merges the array with the additions, yielding binary SHA1s in order.
+        removed = set(binascii.unhexlify(rev) for rev in self._removed)
+        base = (sha for sha in self._iterBinary() if sha not in removed)
+        added = sorted(binascii.unhexlify(rev) for rev in self._added)
+        return heapq.merge(base, added)
+
+class StateJournal(object):
+    """ Append-only log of the state changes made by each run, replayed on top
+    of the last snapshot. Each record is framed by its length and CRC so that
+    a torn final record can be detected and dropped. Replaying is idempotent,
+    so records already folded into a snapshot do no harm. """
+
+    MaxRecords = 1000
+    MinSize = 65536
+
+    def __init__(self, file):
+        self.file = file
+        self.records = 0
+
+    def replay(self, state):
+        if not os.path.exists(self.file):
+            return
+
+        data = open(self.file, "rb").read()
+        offset = 0
+
+        while offset < len(data):
+            end = data.find("\n", offset)
+            m = end >= 0 and re.match(r"^J (\d+) ([0-9a-f]{8})$", data[offset:end])
+            if not m:
+                break
+
+            start = end + 1
+            payload = data[start:start + int(m.group(1))]
+
+            if len(payload) != int(m.group(1)) or crc(payload) != m.group(2):
+                break
+
+            state.readText(payload.splitlines())
+            offset = start + len(payload)
+            self.records += 1
+
+        if offset < len(data):
+            log("Dropping torn record at offset %d of %s" % (offset, self.file))
+            out = open(self.file, "r+b")
+            out.truncate(offset)
+            out.close()
+
+    def append(self, delta):
+        out = open(self.file, "ab")
+        out.write("J %d %s\n" % (len(delta), crc(delta)))
+        out.write(delta)
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        self.records += 1
+
+    def needsCompaction(self, snapshot):
+        # Compacting once the journal reaches half the snapshot's size keeps
+        # the amortized write cost proportional to the changes.
+        size = os.path.getsize(self.file)
+
+        if self.records >= self.MaxRecords:
+            return True
+
+        return size > self.MinSize and size > os.path.getsize(snapshot) / 2
+
+    def clear(self):
+        open(self.file, "wb").close()
+        self.records = 0
+
 class State(object):
 
     def __init__(self):
         self.clear()
 
-    def getHeads(self):
-        for (rev, head) in [head.split() for head in git("show-ref --heads")]:
-            if head.startswith("refs/heads/"):
-                head = head[11:]
-            self.heads[head] = rev
-
-    def getTags(self):
-        for (rev, tag) in [head.split() for head in git("show-ref --tags")]:
-            # We are only interested in annotaged tags.
-            type = git("cat-file -t %s" % rev)[0]
+    def getRefs(self):
+        # Lists heads and tags in one go. For tags, we are only interested in
+        # annotated ones, which the object type tells us without asking git
+        # about each tag separately.
+        for line in git(["for-each-ref", "--format=%(objectname) %(objecttype) %(refname)", "refs/heads", "refs/tags"]):
+            (rev, type, ref) = line.split(" ", 2)
 
-            if type == "tag":
-                if tag.startswith("refs/tags/"):
-                    tag= tag[10:]
+            if ref.startswith("refs/heads/"):
+                self.heads[ref[11:]] = rev
 
-                self.tags[tag] = rev
+            elif ref.startswith("refs/tags/") and type == "tag":
+                self.tags[ref[10:]] = rev
 
     def getReachableRefs(self):
-        for rev in git(["rev-list"] + self.heads.keys() + self.tags.keys()):
+        refs = self.heads.values() + self.tags.values()
+        if not refs:
+            return
+
+        for rev in gitStream(["rev-list", "--stdin"], input=refs):
             self.revs.add(rev)
 
+    def applyUpdates(self, cache, updates):
+        # Derives heads and tags from the cached ones plus the ref updates
+        # git passed to the hook, instead of listing all refs again. Returns
+        # False if an update doesn't start from the cached value, meaning the
+        # cache has missed some change (e.g., hooks running out of order).
+        self.heads = dict(cache.heads)
+        self.tags = dict(cache.tags)
+
+        types = objectTypes([rev for (old, new, ref) in updates if ref.startswith("refs/tags/") for rev in (old, new)])
+
+        for (old, new, ref) in updates:
+            if ref.startswith("refs/heads/"):
+                head = ref[11:]
+
+                if cache.heads.get(head, ZeroRev) != old:
+                    return False
+
+                self.heads.pop(head, None)
+
+                if new != ZeroRev:
+                    self.heads[head] = new
+
+            elif ref.startswith("refs/tags/"):
+                tag = ref[10:]
+
+                # The cache has annotated tags only, so a lightweight one
+                # must not be in it.
+                if tag in cache.tags and cache.tags[tag] != old:
+                    return False
+
+                if tag not in cache.tags and old != ZeroRev and types.get(old) in ("tag", None):
+                    return False
+
+                self.tags.pop(tag, None)
+
+                # We are only interested in annotaged tags.
+                if types.get(new) == "tag":
+                    self.tags[tag] = new
+
+        return True
+
+    def getReachableDelta(self, cache):
+        # Updates the cached set of reachable revisions by walking only what
+        # lies between the cached refs and the current ones.
+        old = set(cache.heads.values() + cache.tags.values())
+        new = set(self.heads.values() + self.tags.values())
+
+        self.added = revListExcluding(new - old, old)
+        self.removed = revListExcluding(old - new, new)
+
+        self.revs = cache.revs.copy()
+        self.revs.difference_update(self.removed)
+        self.revs.update(self.added)
+
     @classmethod
     def getCurrent(klass):
         state = State()
-        state.getHeads()
-        state.getTags()
+        state.getRefs()
         state.getReachableRefs()
         return state
 
+    @classmethod
+    def getIncremental(klass, cache, updates):
+        # Returns None if the updates don't fit the cache.
+        state = State()
+
+        if not state.applyUpdates(cache, updates):
+            return None
+
+        state.getReachableDelta(cache)
+        return state
+
+    def newRevisions(self, cache):
+        # Returns the revisions reachable now but not at the time of the cache.
+        if self.added is None:
+            self.added = set(rev for rev in self.revs if rev not in cache.revs)
+
+        return set(self.added)
+
+    def lostRevisions(self, cache):
+        # Returns the revisions reachable at the time of the cache but not now.
+        if self.removed is None:
+            self.removed = set(rev for rev in cache.revs if rev not in self.revs)
+
+        return set(self.removed)
+
+    def deltaFrom(self, cache):
+        # Returns the changes since *cache* as a journal record.
+        out = StringIO()
+
+        for (type, old, new) in (("head", cache.heads, self.heads), ("tag", cache.tags, self.tags)):
+            for (key, rev) in new.items():
+                if old.get(key) != rev:
+                    print >>out, type, key, rev
+
+            for key in old:
+                if key not in new:
+                    print >>out, "-%s" % type, key
+
+        for rev in self.newRevisions(cache):
+            print >>out, "rev", rev
+
+        for rev in self.lostRevisions(cache):
+            print >>out, "-rev", rev
+
+        for diff in self.diffs - cache.diffs:
+            print >>out, "diff", diff
+
+        return out.getvalue()
+
     def clear(self):
         self.heads = {}
         self.tags = {}
-        self.revs = set()
+        self.revs = RevisionStore()
         self.diffs = set()
 
-        self.reported = set() # Revs reported this run so far.
+        self.added = None   # New revs relative to the cache, once known.
+        self.removed = None # Revs no longer reachable, once known.
+        self.journal = None # Journal replayed by readFrom().
+
+        self.reported = set() # Revs reported this run so far.
+
+    def writeTo(self, file):
+        if os.path.exists(CacheFile):
+            try:
+                shutil.move(CacheFile, CacheFile + ".bak")
+            except IOError:
+                pass
+
+        text = StringIO()
+
+        for (head, ref) in self.heads.items():
+            print >>text, "head", head, ref
+
+        for (tag, ref) in self.tags.items():
+            print >>text, "tag", tag, ref
+
+        for diff in self.diffs:
+            print >>text, "diff", diff
+
+        text = text.getvalue()
+        tmp = file + ".tmp"
+        out = open(tmp, "wb")
+        out.write(StateHeader.pack(StateMagic, len(text), len(self.revs)))
+        out.write(text)
+
+        for sha in self.revs.sortedBinary():
+            out.write(sha)
+
+        out.close()
+        os.rename(tmp, file)
+
+    def saveTo(self, file, cache):
+        # Appends the changes since *cache* to the file's journal, folding
+        # the journal into a new snapshot once it has grown large enough.
+        if not cache.journal:
+            self.writeTo(file)
+            self.journal = StateJournal(file + ".journal")
+            self.journal.clear()
+            return
+
+        self.journal = cache.journal
+        self.journal.append(self.deltaFrom(cache))
+
+        if self.journal.needsCompaction(file):
+            log("Compacting state journal")
+            self.writeTo(file)
+            self.journal.clear()
+
+    def readFrom(self, file):
+        self.clear()
+
+        input = open(file, "rb")
+
+        if input.read(len(StateMagic)) != StateMagic:
+            # Text format written by earlier versions, which did not keep a
+            # journal. The next saveTo() converts it into a snapshot.
+            input.seek(0)
+            self.readText(input)
+            input.close()
+            return
+
+        input.seek(0)
+        data = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        input.close()
+
+        (magic, textlen, count) = StateHeader.unpack(data[:StateHeader.size])
+        offset = StateHeader.size + textlen
+
+        if len(data) != offset + count * 20:
+            error("state file %s is truncated" % file)
+
+        self.readText(data[StateHeader.size:offset].splitlines())
+        self.revs = RevisionStore(data, offset, count)
+
+        self.journal = StateJournal(file + ".journal")
+        self.journal.replay(self)
+
+    def readText(self, input):
+        for line in input:
+
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            m = line.split()
+
+            if len(m) == 3:
+                (type, key, val) = (m[0], m[1], m[2])
+            else:
+                # No heads.
+                (type, key, val) = (m[0], m[1], "")
+
+            if type == "head":
+                self.heads[key] = val
+
+            elif type == "tag":
+                self.tags[key] = val
+
+            elif type == "rev":
+                self.revs.add(key)
+
+            elif type == "diff":
+                self.diffs.add(key)
+
+            elif type == "-head":
+                self.heads.pop(key, None)
+
+            elif type == "-tag":
+                self.tags.pop(key, None)
+
+            elif type == "-rev":
+                self.revs.discard(key)
+
+            elif type == "-diff":
+                self.diffs.discard(key)
+
+            else:
+                error("unknown type %s in cache file" % type)
+
+
+def log(msg):
+    print >>Config.log, "%s - %s" % (time.asctime(), msg)
+
+def error(msg):
+    log("Error: %s" % msg)
+    sys.exit(1)
+
+def crc(data):
+    return "%08x" % (binascii.crc32(data) & 0xffffffff)
+
+# Opens a file for locking it. It's marked close-on-exec so that git children
+# don't hold on to the lock after we've released it.
+def openLock(file):
+    lock = open(file, "a")
+    flags = fcntl.fcntl(lock.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(lock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return lock
+
+# Serializes runs for the same repository, so that concurrent pushes don't
+# both work off the same cached state. The lock is held until the returned
+# file gets closed.
+def lockState():
+    lock = openLock(LockFile)
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    return lock
+
+class GitCall(object):
+    """ Record of one git invocation. """
+
+    def __init__(self, args):
+        self.args = args
+        self.start = time.time()
+        self.seconds = None
+        self.bytes = 0     # Read from its stdout.
+        self.status = None # Exit code.
+        self.phases = list(ActivePhases)
+
+        for phase in self.phases:
+            phase.calls += 1
+
+    def finish(self, status):
+        self.seconds = time.time() - self.start
+        self.status = status
+
+        for phase in self.phases:
+            phase.git_bytes += self.bytes
+
+        if Config and Config.debug:
+            log("git %s: %.3fs, %d bytes, exit %d" % (" ".join(self.args), self.seconds, self.bytes, status))
+
+GitCalls = [] # All invocations of the current run.
+
+class Phase(object):
+    """ Time, git calls, and bytes of one phase of a run, summed over all the
+    times it's entered. Used as a context manager. A phase entered inside
+    another one counts towards both. """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.calls = 0     # git processes started.
+        self.git_bytes = 0 # Read from those.
+        self.bytes = 0     # Produced by the phase itself, if it says so.
+        self.start = None
+
+    def __enter__(self):
+        self.count += 1
+        self.start = time.time()
+        ActivePhases.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        ActivePhases.remove(self)
+        self.seconds += time.time() - self.start
+        return False
+
+    def summary(self):
+        return {"count": self.count, "seconds": round(self.seconds, 4), "git_calls": self.calls,
+                "git_bytes": self.git_bytes, "bytes": self.bytes}
+
+Phases = {}       # Name to Phase, for the current run.
+ActivePhases = [] # Entered but not left yet.
+
+# Returns the phase of the current run with the given name.
+def phase(name):
+    if name not in Phases:
+        Phases[name] = Phase(name)
+
+    return Phases[name]
+
+# Appends the metrics of the run started at *start* to Config.metrics as a
+# line of JSON, and starts collecting them anew.
+def writeMetrics(start):
+    if Config and Config.metrics:
+        entry = {"time": int(start), "repository": os.getcwd(), "pid": os.getpid(),
+                 "seconds": round(time.time() - start, 4), "git_calls": len(GitCalls),
+                 "git_bytes": sum(call.bytes for call in GitCalls),
+                 "phases": dict((p.name, p.summary()) for p in Phases.values())}
+
+        out = open(Config.metrics, "a")
+        print >>out, json.dumps(entry, sort_keys=True)
+        out.close()
+
+    Phases.clear()
+
+# Writes a report of where *profiler* found the time to go.
+def writeProfile(profiler, file):
+    profiler.disable()
+    out = open(file, "w")
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(50)
+    out.close()
+
+def gitArgs(args):
+    if isinstance(args, basestring):
+        return shlex.split(args)
+
+    return list(args)
+
+# Starts a git process without going through a shell, returning the child
+# and the record of the call.
+def gitStart(args, stdin=None, stdout=subprocess.PIPE, stderr=None):
+    call = GitCall(gitArgs(args))
+    GitCalls.append(call)
+
+    try:
+        child = subprocess.Popen(["git"] + call.args, stdin=stdin, stdout=stdout, stderr=stderr)
+    except OSError, e:
+        error("cannot start git: %s" % str(e))
+
+    return (child, call)
+
+def gitCheck(call, stderr):
+    if call.status != 0:
+        stderr.seek(0)
+        msg = stderr.read()
+
+        if msg:
+            error("git child failed with exit code %d: %s" % (call.status, msg))
+
+def feedLines(pipe, lines):
+    try:
+        for line in lines:
+            pipe.write("%s\n" % line)
+
+        pipe.close()
+
+    except IOError:
+        # Child exited without reading everything.
+        pass
+
+# Runs git, yielding its output lines (without the trailing newline) as they
+# arrive. *input* is an optional iterable of lines to write to its stdin. If
+# the caller stops iterating early, the child is killed.
+def gitStream(args, input=None, check=True):
+    stderr = tempfile.TemporaryFile()
+
+    if input is None:
+        (child, call) = gitStart(args, stderr=stderr)
+    else:
+        (child, call) = gitStart(args, stdin=subprocess.PIPE, stderr=stderr)
+        feeder = threading.Thread(target=feedLines, args=(child.stdin, input))
+        feeder.daemon = True
+        feeder.start()
+
+    completed = False
+
+    try:
+        for line in iter(child.stdout.readline, ""):
+            call.bytes += len(line)
+            yield line.rstrip("\n")
+
+        completed = True
+
+    finally:
+        if not completed and child.poll() is None:
+            child.kill()
+
+        child.stdout.close()
+        call.finish(child.wait())
+
+    if check:
+        gitCheck(call, stderr)
+
+def git(args, all=False, check=True):
+    if not all:
+        return [line.strip() for line in gitStream(args, check=check) if line]
+    else:
+        return list(gitStream(args, check=check))
+
+RevisionChunk = 1000 # Revisions handled at a time.
+
+# Splits a list of revisions into chunks of RevisionChunk.
+def chunks(revs):
+    for i in range(0, len(revs), RevisionChunk):
+        yield revs[i:i + RevisionChunk]
+
+# Returns the set of revisions reachable from any of *include* but from none of
+# *exclude*. Refs that no longer exist are ignored.
+def revListExcluding(include, exclude):
+    if not include:
+        return set()
+
+    revs = list(include) + ["^%s" % rev for rev in exclude]
+    return set(gitStream(["rev-list", "--ignore-missing", "--stdin"], input=revs))
+
+# Returns a dictionary mapping each of the given revisions to its object type,
+# asking a single git process for all of them.
+def objectTypes(revs):
+    revs = [rev for rev in revs if rev != ZeroRev]
+    if not revs:
+        return {}
+
+    types = {}
+
+    for line in gitStream(["cat-file", "--batch-check"], input=revs):
+        m = line.split()
+        if len(m) == 3:
+            types[m[0]] = m[1]
+
+    return types
+
+# Parses the "<old-rev> <new-rev> <ref>" lines that git passes to a
+# post-receive hook on stdin.
+def readUpdates(input):
+    updates = []
+
+    for line in input:
+        m = line.split()
+        if len(m) == 3:
+            updates.append(tuple(m))
+
+    return updates
+
+class Commit(object):
+    """ Commit parsed from its raw object. """
+
+    def __init__(self, rev, data):
+        (header, sep, self.message) = data.partition("\n\n")
+
+        self.rev = rev
+        self.parents = []
+        self.author = ""
+        self.date = ""
+
+        for line in header.split("\n"):
+            (key, sep, value) = line.partition(" ")
+
+            if key == "parent":
+                self.parents.append(value)
+
+            elif key == "author":
+                (self.author, self.date) = parseIdent(value)
+
+        # Like git's %s, the subject is the first paragraph on one line.
+        para = self.message.lstrip("\n").split("\n\n")[0]
+        self.subject = " ".join(line.strip() for line in para.strip().split("\n"))
+
+    def nodiff(self):
+        return NoDiff in self.message
+
+    def nomail(self):
+        return NoMail in self.message
+
+# Splits a "Name <email> timestamp tz" line from a commit header into the
+# identity and a date formatted the way git shows it by default.
+def parseIdent(value):
+    m = re.match(r"^(.*>) (\d+) ([+-])(\d\d)(\d\d)$", value)
+    if not m:
+        return (value, "")
+
+    offset = (int(m.group(4)) * 60 + int(m.group(5))) * 60
+    if m.group(3) == "-":
+        offset = -offset
+
+    t = time.gmtime(int(m.group(2)) + offset)
+    date = "%s %d %s %s%s%s" % (time.strftime("%a %b", t), t.tm_mday, time.strftime("%H:%M:%S %Y", t),
+                                m.group(3), m.group(4), m.group(5))
+    return (m.group(1), date)
+
+class ObjectReader(object):
+    """ Reads objects through long-running "git cat-file --batch" and
+    "--batch-check" processes, started on first use and shared by all
+    lookups of a run. Commits known to be needed can be read ahead in one
+    go with prefetch(). """
+
+    def __init__(self):
+        self._batch = None
+        self._check = None
+        self._commits = {}
+        self._abbrevs = {} # Filled by prefetch().
+        self._paths = {}   # Revision to the paths it changes.
+
+    def _query(self, (child, call), rev):
+        child.stdin.write("%s\n" % rev)
+        child.stdin.flush()
+        line = child.stdout.readline()
+        call.bytes += len(line)
+        return line.split()
+
+    def _start(self, mode):
+        return gitStart(["cat-file", mode], stdin=subprocess.PIPE)
+
+    def read(self, rev):
+        # Returns the type and content of an object.
+        if not self._batch:
+            self._batch = self._start("--batch")
+
+        m = self._query(self._batch, rev)
+        if len(m) != 3:
+            error("cannot read object %s" % rev)
+
+        (child, call) = self._batch
+        data = child.stdout.read(int(m[2]) + 1)[:-1] # Strip trailing newline.
+        call.bytes += len(data) + 1
+        return (m[1], data)
+
+    def commit(self, rev):
+        if rev not in self._commits:
+            (type, data) = self.read(rev)
+
+            if type != "commit":
+                error("%s is a %s, not a commit" % (rev, type))
+
+            self._commits[rev] = Commit(rev, data)
+
+        return self._commits[rev]
+
+    def prefetch(self, revs):
+        # Reads the commits among *revs* not known yet with a single git log
+        # run, along with the abbreviations git picks for them.
+        revs = [rev for rev in revs if rev not in self._commits]
+
+        for chunk in chunks(revs):
+            self._prefetch(chunk)
+
+    def _prefetch(self, revs):
+        format = "%H %h%n%P%n%an <%ae> %ad%n%B"
+        output = "\n".join(gitStream(["log", "--no-walk", "--stdin", "-z", "--date=raw", "--format=%s" % format], input=revs))
+
+        for record in output.split("\0"):
+            lines = record.lstrip("\n").split("\n", 3)
+            if len(lines) < 4:
+                continue
+
+            (rev, abbrev) = lines[0].split()
+            header = ["parent %s" % parent for parent in lines[1].split()] + ["author %s" % lines[2]]
+            self._commits[rev] = Commit(rev, "\n".join(header) + "\n\n" + lines[3])
+            self._abbrevs[rev] = abbrev
+
+    def paths(self, rev):
+        # Returns the paths a commit changes; for a merge, relative to its
+        # first parent.
+        if rev not in self._paths:
+            self.prefetchPaths([rev])
+
+        return self._paths[rev]
+
+    def prefetchPaths(self, revs):
+        # Reads the changed paths of the commits among *revs* not known yet
+        # with a single git diff-tree run.
+        revs = [rev for rev in revs if rev not in self._paths]
+
+        for chunk in chunks(revs):
+            self._prefetchPaths(chunk)
+
+    def _prefetchPaths(self, revs):
+        args = ["diff-tree", "--stdin", "-r", "-m", "--root", "--name-only", "-z"]
+        output = "\n".join(gitStream(args, input=revs))
+        wanted = set(revs)
+        paths = None
+
+        for field in output.split("\0"):
+            if field in wanted:
+                # With -m, a merge's diffs against its other parents follow
+                # the one against the first; these are skipped.
+                wanted.remove(field)
+                paths = self._paths[field] = []
+
+            elif len(field) == 40 and field in self._paths:
+                paths = None
+
+            elif field and paths is not None:
+                paths.append(field)
+
+        for rev in wanted:
+            self._paths[rev] = []
+
+    def abbrev(self, rev, length=7):
+        # Returns the shortest unique prefix of at least *length* characters.
+        if length == 7 and rev in self._abbrevs:
+            return self._abbrevs[rev]
+
+        if not self._check:
+            self._check = self._start("--batch-check")
+
+        while length < len(rev) and self._query(self._check, rev[:length])[-1] == "ambiguous":
+            length += 1
+
+        return rev[:length]
+
+    def describe(self, rev):
+        # Returns "<subject> (<abbreviated rev>)" for a commit.
+        return "%s (%s)" % (self.commit(rev).subject, self.abbrev(rev))
+
+    def close(self):
+        for process in (self._batch, self._check):
+            if process:
+                (child, call) = process
+                child.stdin.close()
+                call.finish(child.wait())
+
+        self._batch = self._check = None
+
+Objects = ObjectReader()
+
+class BranchIndex(object):
+    """ Maps the revisions that are new since the cached state to the heads
+    containing them. Only heads that moved need to be walked, and each walk
+    stops at the cached refs, so it covers just the new revisions. Revisions
+    outside of that set are left to "git branch --contains". """
+
+    def __init__(self):
+        self.heads = []
+        self.bits = {}
+
+    def build(self, cache, current, revs):
+        self.heads = sorted(current.heads.keys())
+        self.bits = dict((rev, 0) for rev in revs)
+
+        old = set(cache.heads.values() + cache.tags.values())
+
+        for (i, head) in enumerate(self.heads):
+            rev = current.heads[head]
+            if rev in old:
+                # Can't reach anything new.
+                continue
+
+            for rev in revListExcluding([rev], old):
+                self.bits[rev] = self.bits.get(rev, 0) | (1 << i)
+
+    def lookup(self, rev):
+        # Returns the sorted list of heads containing rev, or None if unknown.
+        mask = self.bits.get(rev)
+        if mask is None:
+            return None
+
+        return [head for (i, head) in enumerate(self.heads) if mask & (1 << i)]
+
+    def contains(self, rev):
+        heads = self.lookup(rev)
+
+        if heads is None:
+            heads = [head.split()[-1] for head in git(["branch", "--contains=%s" % rev])]
+
+        return heads
+
+Branches = BranchIndex()
+
+class Mail(object):
+
+    def __init__(self, sender, recipients, subject, reply_to, mailer):
+        self.mime_text = mime_text = MIMEMultipart() 
+        self.sender = mime_text['From'] = sender
+        self.reply_to = mime_text['Reply-To'] = reply_to
+        self.recipients = mime_text['To'] = recipients
+        mime_text['Subject'] = subject
+        mime_text['X-Mailer'] = mailer
+            
+    def addTag(self, key, value):
+         self.mime_text["%-11s" % key] = value
+         
+    def attachHtml(self, message):
+        with phase("mime"):
+            mime_html = MIMEText(message, 'html')
+            self.mime_text.attach(mime_html)
+
+    def attachText(self, message):
+        with phase("mime"):
+            mime_text = MIMEText(message, 'plain')
+            self.mime_text.attach(mime_text)
+
+    def attachGzip(self, data, name):
+        with phase("mime"):
+            mime_gzip = MIMEBase('application', 'gzip')
+            mime_gzip.set_payload(data)
+            Encoders.encode_base64(mime_gzip)
+            mime_gzip.add_header('Content-Disposition', 'attachment', filename=name)
+            self.mime_text.attach(mime_gzip)
+        
+    def __str__(self):
+        with phase("mime") as p:
+            text = self.mime_text.as_string()
+            p.bytes += len(text)
+            return text
+            
+def generateMailHeader(cfg, subject, recipients=None):
+
+    repo = cfg.repouri
+    
+    if not repo:
+
+        if gitolite:
+            # Gitolite version.
+            repo = "ssh://%s@%s/%s" % (whoami, cfg.hostname, os.path.basename(os.getcwd()))
+        else:
+            # Standard version.
+            repo = "ssh://%s/%s" % (cfg.hostname, os.path.basename(os.getcwd()))
+
+        if repo.endswith(".git"):
+            repo = repo[0:-4]
+
+    replyto = cfg.replyto
+    final_subject = "%s %s" % (cfg.emailprefix,subject)
+    replyto = "%sX-Git-Repository: %s" % (replyto, repo)
+    mailer = "%s %s" % (Name, VERSION)
+    mail = Mail(cfg.sender, recipients or cfg.mailinglist, final_subject, replyto, mailer)
+    mail.addTag("Repository", repo) 
+    return mail
+
+class MailSequence(object):
+    """ Dates and threads mails so that their order shows even when they're
+    sent back-to-back: dates are the time of sending, never going back,
+    Message-IDs carry a sequence number, and each mail replies to the one
+    sent before it in its push. """
+
+    MaxReferences = 20 # Message-IDs in References, the first and the latest.
+
+    def __init__(self):
+        self.last = 0
+        self.count = 0
+        self.thread = [] # Message-IDs for References, see MaxReferences.
+
+    def startPush(self):
+        self.thread = []
+
+    def stamp(self, mail):
+        self.count += 1
+        self.last = max(int(time.time()), self.last)
+        msgid = "<%d.%d.%d.%s@%s>" % (self.last, os.getpid(), self.count, Name, Config.hostname)
+
+        mail.mime_text["Date"] = formatdate(self.last, localtime=True)
+        mail.mime_text["Message-ID"] = msgid
+
+        if self.thread:
+            mail.mime_text["In-Reply-To"] = self.thread[-1]
+            mail.mime_text["References"] = " ".join(self.thread)
+
+        self.thread.append(msgid)
+
+        if len(self.thread) > self.MaxReferences:
+            del self.thread[1]
+
+Sequence = MailSequence()
+
+class TokenBucket(object):
+    """ Rate limiter letting through *rate* events per second on average,
+    and bursts of up to *burst* at once. A rate of zero means no limit. """
+
+    def __init__(self, rate, burst, clock=None, sleep=None):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.clock = clock or time.time
+        self.sleep = sleep or time.sleep
+        self.last = self.clock()
+
+    def take(self):
+        if not self.rate:
+            return
+
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+            self.last += wait
+            self.tokens = 1
+
+        self.tokens -= 1
+
+def sendMail(mail):
+    Sequence.stamp(mail)
+
+    if Config.debug:
+        print str(mail)
+        return
+
+    Config.pacer().take()
+
+    if Config.use_sendmail:
+        stdin = subprocess.Popen("/usr/sbin/sendmail -t", shell=True, stdin=subprocess.PIPE).stdin
+        print >>stdin, str(mail),
+        stdin.close()
+    else:
+        recipients = [addr for (name, addr) in getaddresses([mail.recipients]) if addr]
+        mailer.send(mail.sender, recipients, str(mail))
+
+def entryAdded(key, value, rev):
+    log("New %s %s" % (key, value))
+
+    mail = generateMailHeader(Config, "%s '%s' created" % (key, value))
+
+    mail.addTag("New %s" % key, value)
+    mail.addTag("Referencing", rev)
+
+    sendMail(mail)
+
+def entryDeleted(key, value):
+    log("Deleted %s %s" % (key, value))
+
+    mail = generateMailHeader(Config, "%s '%s' deleted" % (key, value))
+
+    mail.addTag("Deleted %s" % key, value)
+
+    sendMail(mail)
+
+# Returns the output of a diff command, or None if it exceeds *limit* bytes.
+# In the latter case, git gets stopped as soon as the limit is crossed.
+def readDiff(diff_cmd, limit):
+    out = StringIO()
+    size = 0
+    lines = gitStream(diff_cmd)
+
+    for line in lines:
+        size += len(line) + 1
+
+        if size > limit:
+            lines.close()
+            return None
+
+        out.write(line + "\n")
+
+    return out.getvalue()
+
+# Turns a diff command into one reporting just the diffstat.
+def statCommand(diff_cmd, stat=["--stat"]):
+    cmd = []
+
+    for arg in diff_cmd:
+        if arg == "--patch-with-stat":
+            cmd += stat
+        else:
+            cmd.append(arg)
+
+    return cmd
+
+# Returns (added, deleted, paths) for each file a diff command touches, from
+# a cheap --numstat run. The counts are None for binary files; *paths* lists
+# both names for renames and copies.
+def diffNumstat(diff_cmd):
+    tokens = "\n".join(gitStream(statCommand(diff_cmd, ["--numstat", "-z"]))).split("\0")
+    files = []
+    i = 0
+
+    while i < len(tokens):
+        m = tokens[i].split("\t")
+        i += 1
+
+        if len(m) != 3:
+            # The commit diff-tree starts with.
+            continue
+
+        if m[2]:
+            paths = [m[2]]
+        else:
+            paths = tokens[i:i + 2]
+            i += 2
+
+        if m[0] == "-":
+            # Binary.
+            files.append((None, None, paths))
+        else:
+            files.append((int(m[0]), int(m[1]), paths))
+
+    return files
+
+def isGenerated(path):
+    patterns = [p.strip() for p in (Config.generated or "").split(",") if p.strip()]
+    return any(fnmatch.fnmatch(path, p) for p in patterns)
+
+# Decides from the numstat which files' diffs to leave out of a mail, so that
+# git doesn't generate them in the first place. Returns the (paths, reason)
+# tuples of the files dropped and the paths of the files kept.
+def dropFiles(files, limit, file_limit):
+    dropped = []
+    kept = []
+
+    for (added, deleted, paths) in files:
+        if isGenerated(paths[-1]):
+            dropped.append((paths, "generated"))
+            continue
+
+        # Each changed line takes at least two bytes in the diff.
+        size = 2 * ((added or 0) + (deleted or 0))
+
+        if size > file_limit:
+            dropped.append((paths, "too large"))
+        else:
+            kept.append((size, paths))
+
+    # If the remaining files can't fit together, drop the largest ones.
+    kept.sort(reverse=True)
+    total = sum(size for (size, paths) in kept)
+
+    while total > limit:
+        (size, paths) = kept.pop(0)
+        dropped.append((paths, "too large"))
+        total -= size
+
+    return (dropped, [paths for (size, paths) in kept])
+
+PathspecBudget = 64 * 1024 # Bytes of pathspecs to put on a command line at most.
+
+# Restricts a diff command to everything but the given paths.
+def excludePaths(diff_cmd, paths):
+    return diff_cmd + ["--", ":/"] + [":(top,exclude,literal)%s" % path for path in paths]
+
+# Restricts a diff command to just the given paths.
+def includePaths(diff_cmd, paths):
+    return diff_cmd + ["--"] + [":(top,literal)%s" % path for path in paths]
+
+# Returns a diff command restricted to the files kept, naming either the ones
+# dropped or the ones kept, whichever takes less space. Returns None if even
+# that exceeds PathspecBudget, as the command might not run then.
+def restrictPaths(diff_cmd, dropped, kept):
+    excluded = excludePaths([], [path for (paths, reason) in dropped for path in paths])
+    included = includePaths([], [path for paths in kept for path in paths])
+    args = min((excluded, included), key=lambda args: sum(len(arg) + 1 for arg in args))
+
+    if sum(len(arg) + 1 for arg in args) > PathspecBudget:
+        return None
+
+    return diff_cmd + args
+
+# Cuts the patches of files exceeding *limit* bytes after the last hunk that
+# fits, returning the new diff text and the paths of the files cut.
+def truncatePatches(data, limit):
+    parts = []
+    truncated = []
+    pos = 0
+
+    for patch in GitDiffParser().patches(data):
+        if patch.size() <= limit:
+            continue
+
+        cut = patch.hunks and patch.hunks[0].start or patch.end
+
+        for hunk in patch.hunks:
+            if hunk.end - patch.start > limit:
+                break
+
+            cut = hunk.end
+
+        parts.append(data[pos:cut])
+        truncated.append(patch.path)
+        pos = patch.end
+
+    if not truncated:
+        return (data, [])
+
+    parts.append(data[pos:])
+    return ("".join(parts), truncated)
+
+# Reads the diff for a mail, leaving out generated files and those exceeding
+# the per-file limit, and cutting files that turn out larger than expected.
+# Returns the diff (empty if all files are left out), or None if it's too
+# large overall, along with a list of (path, reason) tuples for what's missing.
+def readDiffPerFile(diff_cmd, limit, file_limit):
+    (dropped, kept) = dropFiles(diffNumstat(diff_cmd), limit, file_limit)
+    missing = [(paths[-1], reason) for (paths, reason) in dropped]
+
+    if dropped and not kept:
+        return ("", missing)
+
+    if dropped:
+        diff_cmd = restrictPaths(diff_cmd, dropped, kept)
+
+        if diff_cmd is None:
+            return (None, missing)
+
+    data = readDiff(diff_cmd, limit)
+
+    if data is None:
+        return (None, missing)
+
+    (data, truncated) = truncatePatches(data, file_limit)
+    missing += [(path, "truncated") for path in truncated]
+    return (data, missing)
+
+# Sends a mail for a notification consistent of two parts: (1) the output of a
+# show command, and (2) the output of a diff command.
+def sendChangeMail(rev, subject, heads, show_cmd, diff_cmd):
+    mail = renderChangeMail(rev, subject, heads, show_cmd, diff_cmd)
+
+    if mail:
+        sendMail(mail)
+
+# Builds the mail for sendChangeMail(), returning None if the revision asks
+# for none.
+def renderChangeMail(rev, subject, heads, show_cmd, diff_cmd):
+    with phase("commit"):
+        mail = generateMailHeader(Config, subject, routeRecipients(rev))
+
+        if len(heads) > 1:
+            multi = "es"
+        else:
+            multi = ""
+
+        heads = ",".join(heads)
+
+        if Config.link:
+            url = Config.link.replace("%s", rev)
+            mail.addTag("Link", url)
+
+        revision = Objects.commit(rev)
+
+        if revision.nomail():
+            return None
+
+        (text, html, patch) = renderBody(revision, show_cmd, diff_cmd)
+
+        if html:
+            mail.attachHtml(htmlHeader(subject, heads) + html)
+
+        mail.attachText(text)
+
+        if patch:
+            mail.attachGzip(patch, "%s.patch.gz" % Objects.abbrev(rev))
+
+        if Config.debug:
+            print >>sys.stderr, "-- "
+            print >>sys.stderr, "debug: show_cmd = git %s" % " ".join(show_cmd)
+            print >>sys.stderr, "debug: diff_cmd = git %s" % " ".join(diff_cmd)
+
+        return mail
+
+# Returns the text part of a change mail, the HTML part without its header
+# (empty if there's none), and the gzipped diff to attach (empty if it's shown
+# in full), from the cache if possible.
+def renderBody(revision, show_cmd, diff_cmd):
+    file_limit = min(Config.maxfilediffsize, Config.maxdiffsize)
+    cache = RenderCache(RenderCacheDir, Config.cachesize)
+    key = cache.key([VERSION, Config.maxdiffsize, file_limit, Config.generated, Config.inlinediffsize]
+                    + show_cmd + ["--"] + diff_cmd)
+
+    body = cache.get(key)
+    if body:
+        return body
+
+    footer = ""
+    data = stat = None
+    html = patch = ""
+    commands = (" ".join(show_cmd), " ".join(diff_cmd))
+
+    if not revision.nodiff():
+        (data, missing) = readDiffPerFile(diff_cmd, Config.maxdiffsize, file_limit)
+        listing = "\n".join("    %s (%s)" % (path, reason) for (path, reason) in missing)
+
+        too_large = [path for (path, reason) in missing if reason == "too large"]
+
+        if data is None or (not data and too_large):
+            footer = "\nDiff suppressed because of size. To see it, use:\n\n    git %s" % commands[1]
+
+            if missing:
+                footer += "\n\nFiles left out:\n\n" + listing
+
+        elif missing:
+            files = data and "some files" or "all files"
+            footer = "\nDiffs of %s left out. To see them, use:\n\n    git %s\n\n" % (files, commands[1])
+            footer += listing
+
+        if data is None or (not data and missing):
+            stat = "\n".join(git(statCommand(diff_cmd), all=True))
+            data = None
+
+        if data and Config.inlinediffsize and len(data) > Config.inlinediffsize:
+            patch = gzipData(data)
+            footer = ("\nDiff shortened because of size. The attached patch holds all %d bytes of it.\n%s"
+                      % (len(data), footer))
+            data = previewPatches(data, Config.inlinediffsize)
+
+    if data is not None:
+        with phase("html") as p:
+            html = "".join(iterHunks2html(StringIO(data)))
+            p.bytes += len(html)
+
+        text = data + "\n\n\n" + commands[0] + '\n' + commands[1] + '\n' + footer
+    elif stat:
+        text = stat + "\n\n" + commands[0] + '\n' + commands[1] + '\n' + footer
+    else:
+        text = commands[0] + '\n' + commands[1] + '\n' + footer
+
+    cache.put(key, text, html, patch)
+    return (text, html, patch)
+
+# Returns the beginning of a diff up to *limit* bytes, cut after the last
+# complete hunk that fits. Whatever precedes the first file, such as the
+# summary of changes, is always kept.
+def previewPatches(data, limit):
+    patches = GitDiffParser().patches(data)
+    cut = patches and patches[0].start or len(data)
+
+    for patch in patches:
+        for hunk in patch.hunks:
+            if hunk.end > limit:
+                return data[:cut]
+
+            cut = hunk.end
+
+        if patch.end > limit:
+            return data[:cut]
+
+        cut = patch.end
+
+    return data[:cut]
+
+# Returns data gzip-compressed. The result depends on the data only, so that
+# it can be cached.
+def gzipData(data):
+    out = StringIO()
+    compressed = gzip.GzipFile(fileobj=out, mode="wb", mtime=0)
+    compressed.write(data)
+    compressed.close()
+    return out.getvalue()
+
+RenderCacheDir = ".%s.cache" % Name
+
+class CacheIndex(object):
+    """ A process's view of the files in a cache directory: read once, and
+    then kept up to date with what the process itself stores, uses and
+    removes. """
+
+    def __init__(self, dir):
+        self.files = {} # Name to (modification time, size).
+        self.total = 0
+
+        for name in os.listdir(dir):
+            if name.endswith(".tmp"):
+                # Being written.
+                continue
+
+            try:
+                st = os.stat(os.path.join(dir, name))
+            except OSError:
+                continue
+
+            self.set(name, st.st_mtime, st.st_size)
+
+    def set(self, name, mtime, size):
+        self.remove(name)
+        self.files[name] = (mtime, size)
+        self.total += size
+
+    def remove(self, name):
+        if name in self.files:
+            self.total -= self.files.pop(name)[1]
+
+CacheIndexes = {} # Absolute directory to CacheIndex, for the current run.
+
+class RenderCache(object):
+    """ Rendered mail bodies on disk, one file per key. Files are touched
+    when used, and once the total size exceeds *limit* bytes, the ones
+    unused for longest get removed. The directory is only listed the first
+    time per run; after that, the sizes are tracked in its CacheIndex. A
+    limit of zero disables the cache. """
+
+    def __init__(self, dir, limit):
+        self.dir = dir
+        self.limit = limit
+
+    def key(self, args):
+        return hashlib.sha1("\0".join(str(arg) for arg in args)).hexdigest()
+
+    def get(self, key):
+        # Returns the tuple of parts given to put(), or None if not cached.
+        if not self.limit:
+            return None
+
+        name = os.path.join(self.dir, key)
+
+        try:
+            data = open(name, "rb").read()
+            os.utime(name, None)
+        except (IOError, OSError):
+            return None
+
+        index = CacheIndexes.get(os.path.abspath(self.dir))
+
+        if index:
+            index.set(key, time.time(), len(data))
+
+        (lengths, sep, data) = data.partition("\n")
+        parts = []
+
+        for length in lengths.split():
+            parts.append(data[:int(length)])
+            data = data[int(length):]
+
+        return tuple(parts + [data])
+
+    def put(self, key, *parts):
+        if not self.limit:
+            return
+
+        if not os.path.isdir(self.dir):
+            try:
+                os.mkdir(self.dir)
+            except OSError:
+                # Created concurrently.
+                pass
+
+        # Renamed into place, so that other processes never see partial files.
+        (fd, tmp) = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        out = os.fdopen(fd, "wb")
+        header = "%s\n" % " ".join(str(len(part)) for part in parts[:-1])
+        out.write(header)
+
+        for part in parts:
+            out.write(part)
+
+        out.close()
+        os.rename(tmp, os.path.join(self.dir, key))
+
+        index = self.index()
+        index.set(key, time.time(), len(header) + sum(len(part) for part in parts))
+        self.evict(index)
+
+    def index(self):
+        dir = os.path.abspath(self.dir)
+
+        if dir not in CacheIndexes:
+            CacheIndexes[dir] = CacheIndex(dir)
+
+        return CacheIndexes[dir]
+
+    def evict(self, index):
+        if index.total <= self.limit:
+            return
+
+        for (mtime, name) in sorted((mtime, name) for (name, (mtime, size)) in index.files.items()):
+            if index.total <= self.limit:
+                break
+
+            try:
+                os.unlink(os.path.join(self.dir, name))
+            except OSError:
+                pass
+
+            index.remove(name)
+
+class RenderError(Exception):
+    pass
+
+# Renders the mails for a list of renderChangeMail() argument tuples, using
+# up to Config.parallel processes. Mails are yielded in the order of the jobs,
+# each as soon as it and all before it are ready.
+def renderMails(jobs):
+    if Config.parallel <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield renderChangeMail(*job)
+
+        return
+
+    pool = multiprocessing.Pool(min(Config.parallel, len(jobs)), initializer=startRenderer)
+
+    try:
+        for mail in pool.imap(renderJob, jobs):
+            yield mail
+
+    except RenderError, e:
+        error(str(e))
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+def startRenderer():
+    # The parent's cat-file processes can't be shared with the children, but
+    # what it has read already can.
+    global Objects
+    reader = ObjectReader()
+    reader._commits = Objects._commits
+    reader._abbrevs = Objects._abbrevs
+    reader._paths = Objects._paths
+    Objects = reader
+
+def renderJob(job):
+    try:
+        return renderChangeMail(*job)
+    except SystemExit:
+        # error() has logged the reason already.
+        raise RenderError("cannot render mail for %s" % job[0])
+
+# Sends notification for a specific revision.
+def commit(current, rev, force=False, subject_head=None):
+    job = commitJob(current, rev, force=force, subject_head=subject_head)
+
+    if job:
+        sendChangeMail(*job)
+
+# Prepares the notification for a specific revision, returning the arguments
+# for renderChangeMail(), or None if there's nothing to report.
+def commitJob(current, rev, force=False, subject_head=None):
+    if rev in current.reported and not force:
+        # Already reported in this run of the script.
+        log("Flagged revision %s for notification, but already reported this time" % rev)
+        return None
+
+    log("New revision %s" % rev)
+    current.reported.add(rev)
+
+    heads = Branches.contains(rev)
+    if not subject_head:
+        subject_head = ",".join(heads)
+
+    subject = "%s: %s" % (subject_head, Objects.describe(rev))
+
+    show_cmd = ["show", "-s", "--no-color", "--find-copies-harder", "--pretty=medium", rev]
+    diff_cmd = ["diff-tree", "--patch-with-stat", "--no-color", "--find-copies-harder", "--ignore-space-at-eol", rev]
+
+    return (rev, subject, heads, show_cmd, diff_cmd)
+
+# Sends a diff between two revisions.
+#
+# Only used in manual mode now.
+def diff(head, first, last):
+    # We record a pseudo-revision to avoid sending the same diff twice.
+    rev = "%s-%s" % (head, last)
+    if not rev in current.diffs:
+        log("New diff revision %s" % rev)
+        current.diffs.add(rev)
+
+    log("Diffing %s..%s" % (first, last))
+
+    subject = "%s diff: %s" % (head, Objects.describe(last))
+
+    heads = [head]
+
+    show_cmd = ["show", "-s", "--no-color", "--find-copies-harder", "--pretty=medium", last]
+    diff_cmd = ["diff", "--patch-with-stat", "-m", "--no-color", "--find-copies-harder", "--ignore-space-at-eol", first, last]
+
+    sendChangeMail(last, subject, heads, show_cmd, diff_cmd)
+
+# Sends pair-wise diffs for a path of revisions. Also records all revision on
+# the path as seen.
+#
+# Only used in manual mode now.
+def diffPath(head, revs):
+    Objects.prefetch(revs)
+    last = None
+
+    for rev in revs:
+        if last:
+            diff(head, last, rev)
+        last = rev
+
+# Sends a commit notifications for a set of revisions.
+def reportPath(current, revs, force=False, subject_head=None):
+    if not revs:
+        return
+
+    # Sort updates by time.
+    revs = list(gitStream(["rev-list", "--no-walk", "--reverse", "--date-order", "--stdin"], input=revs))
+
+    if Config.digest and len(revs) > Config.digest and not force:
+        reportDigest(current, revs, subject_head=subject_head)
+        return
+
+    for chunk in chunks(revs):
+        Objects.prefetch(chunk)
+
+        if Config.routes:
+            Objects.prefetchPaths(chunk)
+
+        jobs = [commitJob(current, rev, force=force, subject_head=subject_head) for rev in chunk]
+
+        for mail in renderMails([job for job in jobs if job]):
+            if mail:
+                sendMail(mail)
+
+DigestMailSize = 1000 # Revisions per digest mail.
+
+# Sends digest mails listing a set of revisions too large to report one by
+# one. The revisions count as reported.
+def reportDigest(current, revs, subject_head=None):
+    revs = [rev for rev in revs if rev not in current.reported]
+    if not revs:
+        return
+
+    log("Reporting %d new revisions as digest" % len(revs))
+    current.reported.update(revs)
+
+    if not subject_head:
+        subject_head = ",".join(Branches.contains(revs[-1]))
+
+    Objects.prefetch(revs)
+    entries = [entry for entry in digestEntries(revs) if not Objects.commit(entry[0]).nomail()]
+    parts = (len(entries) + DigestMailSize - 1) // DigestMailSize
+
+    for part in range(parts):
+        chunk = entries[part * DigestMailSize:(part + 1) * DigestMailSize]
+
+        subject = "%s: %d new revisions" % (subject_head, len(entries))
+        if parts > 1:
+            subject += " (%d/%d)" % (part + 1, parts)
+
+        mail = generateMailHeader(Config, subject)
+
+        out = StringIO()
+        print >>out, "%d revisions were pushed, too many to report them one by one." % len(entries)
+        print >>out, ""
+
+        for (rev, summary, stat) in chunk:
+            print >>out, "    ", summary
+
+            if stat:
+                print >>out, "        ", stat
+
+        mail.attachText(out.getvalue())
+        sendMail(mail)
+
+# Returns (rev, "<abbreviated rev> <subject>", shortstat) for each revision,
+# in the given order, from a single git log run.
+def digestEntries(revs):
+    entries = {}
+    entry = None
+
+    for line in gitStream(["log", "--no-walk", "--stdin", "--shortstat", "--format=%x01%H %h %s"], input=revs):
+        if line.startswith("\x01"):
+            (rev, summary) = line[1:].split(" ", 1)
+            entry = entries[rev] = [rev, summary, ""]
+
+        elif line.strip() and entry:
+            entry[2] = line.strip()
+
+    # git log orders them its own way.
+    return [tuple(entries[rev]) for rev in revs if rev in entries]
+
+# Sends a summary mail for a set of revisions.
+def headMoved(head, path):
+    log("Head moved: %s -> %s" % (head, path[-1]))
+
+    Objects.prefetch(path)
+    mail = generateMailHeader(Config, "%s's head updated: %s" % (head, Objects.describe(path[-1])))
+
+    out = StringIO()
+    print >>out, "Branch '%s' now includes:" % head
+    print >>out, ""
+
+    for rev in path:
+        print >>out, "    ", Objects.abbrev(rev), Objects.commit(rev).subject
+
+    mail.attachText(out.getvalue())
+    sendMail(mail)
+
+# Mails out notifications for everything that changed between the cached and
+# the current state.
+def reportChanges(cache, current):
+    # Check for changes to the set of heads.
+    old = set(cache.heads.keys())
+    new = set(current.heads.keys())
+
+    for head in (new - old):
+        entryAdded("branch", head, current.heads[head])
+
+    for head in (old - new):
+        entryDeleted("branch", head)
+
+    stable_heads = new & old
+
+    allchanges = Config.allchanges & stable_heads
+
+    # Check tags.
+    old = set(cache.tags.keys())
+    new = set(current.tags.keys())
+
+    for tag in (new - old):
+        entryAdded("tag", tag, current.tags[tag])
+
+    for tag in (old - new):
+        entryDeleted("tag", tag)
+
+    # Notify for unreported commits.
+    with phase("refs.diff"):
+        new_revs = current.newRevisions(cache)
+        Branches.build(cache, current, new_revs)
+
+    reportPath(current, new_revs)
+
+    # Do reports for the heads we want to see everything for.
+    for head in stable_heads:
+        old_rev = cache.heads[head]
+        new_rev = current.heads[head]
+        if old_rev == new_rev:
+            continue
+
+        path = git(["rev-list", "--reverse", "--date-order", new_rev, "^%s" % old_rev])
+
+        if head in allchanges:
+            # Want to see all commits for this head, even if already reported
+            # in the past for some other. So we record these separately.
+            reportPath(current, path, subject_head=head)
+        else:
+            # Just send a summary for heads that now include some new stuff.
+            if len(set(path) - new_revs):
+                headMoved(head, path)
+
+# Brings the state file up to date with the repository, reporting the changes
+# unless this is the initial run. *updates* are the ref updates passed to the
+# hook, if known, which allows updating the state incrementally.
+def processUpdates(updates=None):
+    lock = lockState()
+    Sequence.startPush()
+
+    try:
+        cache = State()
+
+        if os.path.exists(CacheFile):
+            cache = loadState()
+            report = (not Config.updateonly)
+        else:
+            log("Initial run. Not generating any mails, just recording current state.")
+            report = False
+
+        with phase("state.current"):
+            current = None
+
+            if updates is not None and os.path.exists(CacheFile):
+                current = State.getIncremental(cache, updates)
+
+                if current is None:
+                    log("Ref updates don't match the recorded state, scanning all refs")
+                    current = State.getCurrent()
+
+                elif Config.verify:
+                    full = State.getCurrent()
+
+                    if (full.heads, full.tags, set(full.revs)) != (current.heads, current.tags, set(current.revs)):
+                        log("Incremental state differs from full scan, using the latter")
+                        current = full
+
+            if current is None:
+                current = State.getCurrent()
+
+        if report:
+            reportChanges(cache, current)
 
-    def writeTo(self, file):
-        if os.path.exists(CacheFile):
-            try:
-                shutil.move(CacheFile, CacheFile + ".bak")
-            except IOError:
-                pass
+        if not Config.noupdate:
+            current.saveTo(CacheFile, cache)
+            keepState(current)
 
-        out = open(file, "w")
+    finally:
+        lock.close()
 
-        for (head, ref) in self.heads.items():
-            print >>out, "head", head, ref
+WarmState = None # (stamp, state) as last saved by this process.
 
-        for (tag, ref) in self.tags.items():
-            print >>out, "tag", tag, ref
+# Returns the cached state, reusing the one this process saved last if the
+# files haven't changed since. That's what keeps a daemon worker from
+# reading the state again for every push.
+def loadState():
+    if WarmState and WarmState[0] == stateStamp():
+        cache = WarmState[1]
+        cache.reported = set()
+        return cache
 
-        for rev in self.revs:
-            print >>out, "rev", rev
+    cache = State()
 
-    def readFrom(self, file):
-        self.clear()
+    with phase("state.read"):
+        cache.readFrom(CacheFile)
 
-        for line in open(file):
+    return cache
 
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
+def keepState(state):
+    global WarmState
+    WarmState = (stateStamp(), state)
 
-            m = line.split()
+def stateStamp():
+    stamp = []
 
-            if len(m) == 3:
-                (type, key, val) = (m[0], m[1], m[2])
-            else:
-                # No heads.
-                (type, key, val) = (m[0], m[1], "")
+    for file in (CacheFile, CacheFile + ".journal"):
+        try:
+            st = os.stat(file)
+            stamp.append((st.st_ino, st.st_size, st.st_mtime))
+        except OSError:
+            stamp.append(None)
 
-            if type == "head":
-                self.heads[key] = val
+    return stamp
 
-            elif type == "tag":
-                self.tags[key] = val
+SpoolDir     = ".%s.spool" % Name
+SpoolRetries = 5
+SpoolBackoff = 30 # Seconds to wait after a failure, times the attempt number.
 
-            elif type == "rev":
-                self.revs.add(key)
+# Queues ref updates for delivery by a background process. *user* is the
+# gitolite user who pushed, if not the one in our environment, and *args* the
+# command line options to deliver them with, if not the deliverer's own.
+def spoolUpdates(updates, user=None, args=None, dir=SpoolDir):
+    if not os.path.isdir(dir):
+        os.mkdir(dir)
 
-            elif type == "diff":
-                self.diffs.add(key)
+    # Names sort in the order the updates arrived.
+    name = os.path.join(dir, "%017.6f-%08d" % (time.time(), os.getpid()))
 
-            else:
-                error("unknown type %s in cache file" % type)
+    out = open(name + ".tmp", "w")
 
+    if user:
+        print >>out, "user", user
 
-def log(msg):
-    print >>Config.log, "%s - %s" % (time.asctime(), msg)
+    for arg in args or []:
+        print >>out, "arg", arg
 
-def error(msg):
-    log("Error: %s" % msg)
-    sys.exit(1)
+    for update in updates:
+        print >>out, " ".join(update)
+    out.close()
 
-def git(args, stdout_to=subprocess.PIPE, all=False):
-    if isinstance(args, tuple) or isinstance(args, list):
-        args = " ".join(args)
-        
-    try:
-        child = subprocess.Popen("git " + args, shell=True, stdin=None, stdout=stdout_to, stderr=subprocess.PIPE)
-        (stdout, stderr) = child.communicate()
-    except OSError, e:
-        error("cannot start git: %s" % str(e))
+    os.rename(name + ".tmp", name + ".updates")
+    log("Spooled %d ref updates as %s" % (len(updates), name))
 
-    if child.returncode != 0 and stderr:
-        if stderr:
-            msg = ": %s" % stderr
-        else:
-            msg = ""
-        error("git child failed with exit code %d%s" % (child.returncode, msg))
+# Starts a detached process delivering the spooled updates.
+def startDelivery(args):
+    devnull = open(os.devnull, "r+")
+    subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), "--deliver"] + args,
+                     stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
 
-    if stdout_to != subprocess.PIPE:
+def spoolEntries():
+    if not os.path.isdir(SpoolDir):
         return []
 
-    if not all:
-        return [line.strip() for line in stdout.split("\n") if line]
-    else:
-        return stdout.split("\n")
+    return sorted(entry for entry in os.listdir(SpoolDir) if entry.endswith(".updates"))
 
-Tmps = []
+# Processes spooled updates in order until none are left. Only one process
+# delivers at a time; others leave their entries to it. If given, *configure*
+# gets called with each entry's options before delivering it.
+def deliverSpool(configure=None):
+    while spoolEntries():
+        lock = openLock(os.path.join(SpoolDir, "lock"))
 
-def makeTmp():
-    global Tmps
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Whoever holds the lock checks for more entries after
+            # releasing it.
+            return
 
-    (fd, fname) = tempfile.mkstemp(prefix="%s-" % Name, suffix=".tmp")
-    Tmps += [fname]
+        try:
+            entries = spoolEntries()
 
-    return (os.fdopen(fd, "w"), fname)
+            while entries:
+                deliverEntry(os.path.join(SpoolDir, entries[0]), configure)
+                entries = spoolEntries()
+        finally:
+            lock.close()
 
-def deleteTmps():
-    for tmp in Tmps:
-        os.unlink(tmp)
+# Reports a spooled set of updates, retrying on failure. The state gets
+# updated only once all mails have been delivered, so an entry that fails
+# midway may send some of its mails again.
+def deliverEntry(entry, configure=None):
+    global gitolite
 
-class Mail(object):
+    lines = open(entry).readlines()
+    updates = readUpdates(lines)
 
-    def __init__(self, sender, recipients, subject, reply_to, mailer):
-        self.mime_text = mime_text = MIMEMultipart() 
-        self.sender = mime_text['From'] = sender
-        self.reply_to = mime_text['Reply-To'] = reply_to
-        self.recipients = mime_text['To'] = recipients
-        mime_text['Subject'] = subject
-        mime_text['X-Mailer'] = mailer
-            
-    def addTag(self, key, value):
-         self.mime_text["%-11s" % key] = value
-         
-    def attachHtml(self, message):
-        mime_html = MIMEText(message, 'html')
-        self.mime_text.attach(mime_html)
+    if configure:
+        configure([line[4:].rstrip("\n") for line in lines if line.startswith("arg ")])
 
-    def attachText(self, message):
-        mime_text = MIMEText(message, 'plain')
-        self.mime_text.attach(mime_text)
-        
-    def __str__(self):
-        return self.mime_text.as_string()
-            
-def generateMailHeader(cfg, subject):
+    for line in lines:
+        if line.startswith("user "):
+            gitolite = True
+            Config.setUser(line.split()[1])
 
-    repo = cfg.repouri
-    
-    if not repo:
+    if not Config.incremental:
+        updates = None
 
-        if gitolite:
-            # Gitolite version.
-            repo = "ssh://%s@%s/%s" % (whoami, cfg.hostname, os.path.basename(os.getcwd()))
-        else:
-            # Standard version.
-            repo = "ssh://%s/%s" % (cfg.hostname, os.path.basename(os.getcwd()))
+    for attempt in range(1, SpoolRetries + 1):
+        try:
+            processUpdates(updates)
+            os.unlink(entry)
+            return
 
-        if repo.endswith(".git"):
-            repo = repo[0:-4]
+        except (Exception, SystemExit), e:
+            # For SystemExit, error() has logged the reason already.
+            log("Delivering %s failed (attempt %d): %s" % (entry, attempt, e))
+            mailer.close()
 
-    replyto = cfg.replyto
-    final_subject = "%s %s" % (cfg.emailprefix,subject)
-    replyto = "%sX-Git-Repository: %s" % (replyto, repo)
-    mailer = "%s %s" % (Name, VERSION)
-    mail = Mail(cfg.sender, cfg.mailinglist, final_subject, replyto, mailer)
-    mail.addTag("Repository", repo) 
-    return mail
+            if attempt < SpoolRetries:
+                time.sleep(SpoolBackoff * attempt)
 
-def sendMail(mail):
-    if Config.debug:
-        print str(mail)
+    log("Giving up on %s" % entry)
+    os.rename(entry, entry + ".failed")
 
-    elif Config.use_sendmail:
-        stdin = subprocess.Popen("/usr/sbin/sendmail -t", shell=True, stdin=subprocess.PIPE).stdin
-        print >>stdin, str(mail),
-        stdin.close()
-    else:
-        mailer.send( mail.sender, mail.recipients, str(mail) )
+DaemonIdle = 600 # Seconds after which the worker for a repository exits.
 
-    # Wait a bit in case we're going to send more mails. Otherwise, the mails
-    # get sent back-to-back and are likely to end up with identical timestamps,
-    # which may then make them appear to have arrived in the wrong order.
-    if not Config.debug:
-        time.sleep(2)
+class DaemonError(Exception):
+    pass
 
-def entryAdded(key, value, rev):
-    log("New %s %s" % (key, value))
+# Serves pushes forwarded by git-notifier-client over a Unix socket. Each
+# push gets spooled in its repository. One worker process per repository
+# delivers them, so pushes to the same repository are reported in order
+# while different repositories proceed in parallel.
+def serveDaemon(path):
+    if os.path.exists(path):
+        os.unlink(path)
 
-    mail = generateMailHeader(Config, "%s '%s' created" % (key, value))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+    server.settimeout(60)
+    log("Daemon listening on %s" % path)
 
-    mail.addTag("New %s" % key, value)
-    mail.addTag("Referencing", rev)
+    workers = {}
 
-    sendMail(mail)
+    while True:
+        try:
+            (conn, addr) = server.accept()
+        except socket.timeout:
+            conn = None
 
-def entryDeleted(key, value):
-    log("Deleted %s %s" % (key, value))
+        if conn:
+            repo = handleClient(conn)
 
-    mail = generateMailHeader(Config, "%s '%s' deleted" % (key, value))
+            if repo:
+                handOff(workers, repo, [server.fileno()])
 
-    mail.addTag("Deleted %s" % key, value)
+        reapWorkers(workers)
 
-    sendMail(mail)
+# Wakes up the worker for the repository of a spooled push, or starts one if
+# there's none. *inherited* are descriptors the new worker must close besides
+# the other workers' pipes.
+def handOff(workers, repo, inherited):
+    if repo in workers and workers[repo].notify():
+        return
 
-# Sends a mail for a notification consistent of two parts: (1) the output of a
-# show command, and (2) the output of a diff command.
-def sendChangeMail(rev, subject, heads, show_cmd, diff_cmd):
+    inherited = inherited + [worker.pipe for worker in workers.values() if worker.pipe is not None]
+    workers[repo] = RepoWorker(repo, inherited)
 
-    mail = generateMailHeader(Config, subject)
+# Spools the push a client sends along with its options, returning the
+# repository it is for, or None if it couldn't be taken.
+def handleClient(conn):
+    conn.settimeout(10)
 
-    if len(heads) > 1:
-        multi = "es"
-    else:
-        multi = ""
-        
-    heads = ",".join(heads)
+    try:
+        try:
+            input = conn.makefile("r")
+            (repo, user, args, updates) = readRequest(input)
+            spoolUpdates(updates, user=user, args=args, dir=os.path.join(repo, SpoolDir))
+            conn.sendall("ok\n")
+            return repo
 
-    if Config.link:
-        url = Config.link.replace("%s", rev)
-        mail.addTag("Link", url)
+        except (DaemonError, IOError, OSError, socket.error), e:
+            log("Rejecting request: %s" % e)
 
-    footer = ""
-    show = git(show_cmd)
+            try:
+                conn.sendall("error %s\n" % e)
+            except socket.error:
+                pass
 
-    for line in show:
-        if NoDiff in line:
-            break
+            return None
 
-        if NoMail in line:
-            return
+    finally:
+        conn.close()
 
-    else:
-        (tmp, tname) = makeTmp()
-        diff = git(diff_cmd, stdout_to=tmp)
-        tmp.close()
-        
-        size = os.path.getsize(tname)
+# Parses a client's request: "repo", "user" and "arg" lines, an empty line,
+# and then the ref updates as the hook got them.
+def readRequest(input):
+    (repo, user, args) = (None, None, [])
 
-        if size > Config.maxdiffsize:
-            footer = "\nDiff suppressed because of size. To see it, use:\n\n    git %s" % diff_cmd
-            tname = None
+    for line in input:
+        line = line.rstrip("\n")
+        if not line:
+            break
 
-    result = git(show_cmd, all=True)
+        (key, sep, value) = line.partition(" ")
 
-    if tname:
-        data = open(tname).read()
-        html = patch2html(data, title=subject, heads=heads)
-        mail.attachHtml(html)
-        mail.attachText(data + "\n\n\n" + show_cmd + '\n' + diff_cmd + '\n' + footer)
-    else:
-        mail.attachText(show_cmd + '\n' + diff_cmd + '\n' + footer)
-    	
-    if Config.debug:
-        print >>out, "-- "
-        print >>out, "debug: show_cmd = git %s" % show_cmd
-        print >>out, "debug: diff_cmd = git %s" % diff_cmd
-        
-    sendMail(mail)
+        if key == "repo":
+            repo = value
+        elif key == "user":
+            user = value
+        elif key == "arg":
+            args.append(value)
+        else:
+            raise DaemonError("unknown request line '%s'" % line)
 
-# Sends notification for a specific revision.
-def commit(current, rev, force=False, subject_head=None):
-    if rev in current.reported and not force:
-        # Already reported in this run of the script.
-        log("Flagged revision %s for notification, but already reported this time" % rev)
-        return
+    if not repo or not os.path.isabs(repo) or not os.path.exists(os.path.join(repo, "HEAD")):
+        raise DaemonError("not a repository: %s" % repo)
 
-    log("New revision %s" % rev)
-    current.reported.add(rev)
+    return (repo, user, args, readUpdates(input))
 
-    heads = [head.split()[-1] for head in git("branch --contains=%s" % rev)]
-    if not subject_head:
-        subject_head = ",".join(heads)
+# Stops workers idle for longer than DaemonIdle and forgets those that have
+# exited.
+def reapWorkers(workers):
+    for (repo, worker) in workers.items():
+        if time.time() - worker.last > DaemonIdle:
+            # It finishes what's spooled and exits; a later push for the
+            # repository gets a new worker. waitpid() below collects it.
+            worker.stop()
+            del workers[repo]
 
-    subject = git("show '--pretty=format:%%s (%%h)' -s %s" % rev)
-    subject = "%s: %s" % (subject_head, subject[0])
+    while True:
+        try:
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            # No children.
+            break
 
-    show_cmd = "show -s --no-color --find-copies-harder --pretty=medium %s" % rev
-    diff_cmd = "diff-tree --patch-with-stat --no-color --find-copies-harder --ignore-space-at-eol %s" % rev
+        if not pid:
+            break
 
-    sendChangeMail(rev, subject, heads, show_cmd, diff_cmd)
+        for (repo, worker) in workers.items():
+            if worker.pid == pid:
+                del workers[repo]
 
-# Sends a diff between two revisions.
-#
-# Only used in manual mode now.
-def diff(head, first, last):
-    # We record a pseudo-revision to avoid sending the same diff twice.
-    rev = "%s-%s" % (head, last)
-    if not rev in current.diffs:
-        log("New diff revision %s" % rev)
-        current.diffs.add(rev)
+class RepoWorker(object):
+    """ Child process delivering the pushes spooled for one repository,
+    keeping its configuration, SMTP session and state across pushes. The
+    daemon wakes it up by writing to a pipe, and closing the pipe makes it
+    exit. *inherited* are descriptors of the daemon the child must close. """
 
-    log("Diffing %s..%s" % (first, last))
+    def __init__(self, repo, inherited=[]):
+        self.repo = repo
+        self.last = time.time()
+        (input, self.pipe) = os.pipe()
+        self.pid = os.fork()
 
-    subject = git("show '--pretty=format:%%s (%%h)' -s %s" % last)
-    subject = "%s diff: %s" % (head, subject[0])
+        if not self.pid:
+            for fd in [self.pipe] + inherited:
+                os.close(fd)
 
-    heads = [head]
+            try:
+                runWorker(repo, input)
+            finally:
+                os._exit(0)
 
-    show_cmd = "show -s --no-color --find-copies-harder --pretty=medium %s" % last
-    diff_cmd = "diff --patch-with-stat -m --no-color --find-copies-harder --ignore-space-at-eol %s %s" % (first, last)
+        os.close(input)
 
-    sendChangeMail(last, subject, heads, show_cmd, diff_cmd)
+    def notify(self):
+        # Returns False if the worker is gone or stopped.
+        if self.pipe is None:
+            return False
 
-# Sends pair-wise diffs for a path of revisions. Also records all revision on
-# the path as seen.
-#
-# Only used in manual mode now.
-def diffPath(head, revs):
-    last = None
+        self.last = time.time()
 
-    for rev in revs:
-        if last:
-            diff(head, last, rev)
-        last = rev
+        try:
+            os.write(self.pipe, "x")
+            return True
+        except OSError:
+            return False
+
+    def stop(self):
+        if self.pipe is not None:
+            os.close(self.pipe)
+            self.pipe = None
+            self.last = time.time()
+
+    def __del__(self):
+        self.stop()
+
+def runWorker(repo, input):
+    os.chdir(repo)
+    loaded = [None] # (configuration stamp, options) of the current Config.
+
+    def configure(args):
+        # Reloads after changes to the repository's configuration, or for
+        # a push with other options.
+        global Config, mailer
+
+        if loaded[0] == (configStamp(), args):
+            return
 
-# Sends a commit notifications for a set of revisions.
-def reportPath(current, revs, force=False, subject_head=None):
-    if not revs:
-        return
+        if loaded[0]:
+            mailer.close()
 
-    # Sort updates by time.
-    revs = git("rev-list --no-walk --reverse --date-order %s" % " ".join(revs))
+        stamp = configStamp()
 
-    for rev in revs:
-        commit(current, rev, force=force, subject_head=subject_head)
+        with phase("config"):
+            Config = GitNotifierConfig(GitConfigProvider())
+            Config.load_args(args)
+            Config.get_config_variables()
 
-# Sends a summary mail for a set of revisions.
-def headMoved(head, path):
-    log("Head moved: %s -> %s" % (head, path[-1]))
+        mailer = makeMailer(Config)
+        loaded[0] = (stamp, args)
 
-    subject = git("show '--pretty=format:%%s (%%h)' -s %s" % path[-1])
+    while True:
+        start = time.time()
 
-    mail = generateMailHeader(Config, "%s's head updated: %s" % (head, subject[0]))
+        try:
+            deliverSpool(configure)
+        except SystemExit:
+            # error() has logged the reason.
+            pass
 
-    print >>out, "Branch '%s' now includes:" % head
-    print >>out, ""
+        Objects.close()
+        writeMetrics(start)
+        del GitCalls[:]
 
-    for rev in path:
-        print >>out, "    ", git("show -s --pretty=oneline --abbrev-commit %s" % rev)[0]
+        if not os.read(input, 4096):
+            break
 
-    sendMail(mail)
+    if loaded[0]:
+        mailer.close()
+
+def configStamp():
+    try:
+        return os.stat("config").st_mtime
+    except OSError:
+        return None
 
 MAILINGLIST = 'hooks.mailinglist'
 EMAILPREFIX = 'hooks.emailprefix'
@@ -533,42 +2745,184 @@ SMTP_HOST = 'hooks.smtp-host'
 SMTP_PORT = 'hooks.smtp-port'
 SMTP_SENDER = 'hooks.smtp-sender'
 SMTP_SENDER_PASSWORD = 'hooks.smtp-sender-password'
+SMTP_MAX_MESSAGES = 'hooks.smtp-max-messages'
 POST_RECEIVE_LOGFILE = 'hooks.post-receive-logfile'
 
+def makeMailer(config):
+    return Mailer(config[SMTP_HOST], config[SMTP_PORT],
+                  config[SMTP_SENDER], config[SMTP_SENDER_PASSWORD],
+                  config[MAILINGLIST], max_messages=config[SMTP_MAX_MESSAGES])
+
 ConfigValueError = ValueError
 
 class GitConfigProvider(object):
+    """ Serves hooks.* variables from one snapshot of the git configuration. """
+
+    def __init__(self):
+        self._values = None
 
     def get(self, name):
-        p = subprocess.Popen(['git', 'config', '--get', name], 
-                             stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        # XXX: what if the program fails ?
-        return stdout.strip()
+        if self._values is None:
+            self._values = readHooksConfig()
+
+        return self._values.get(name.lower(), "")
+
+# Returns a dictionary of all hooks.* variables, read with a single git call.
+# As with "git config --get", the last value of a multi-valued variable wins.
+def readHooksConfig():
+    values = {}
+    out = "\n".join(git(["config", "-z", "--get-regexp", r"^hooks\."], all=True, check=False))
+
+    for entry in out.split("\0"):
+        if entry:
+            (name, _, value) = entry.partition("\n")
+            values[name] = value.strip()
+
+    return values
 
 ONE_MB_IN_BYTES = 1048576
 
+Users = {} # File name to (modification time, user-to-email mapping).
+
+def loadUsers(file):
+    mtime = os.path.getmtime(file)
+
+    if file not in Users or Users[file][0] != mtime:
+        users = {}
+
+        for line in open(file):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            m = line.split()
+            users.setdefault(m[0], " ".join(m[1:]))
+
+        Users[file] = (mtime, users)
+
+    return Users[file][1]
+
+class RouteNode(object):
+    """ Node of a RouteTrie for one path component. """
+
+    def __init__(self):
+        self.children = {}   # Next component to node.
+        self.recipients = [] # Of prefixes ending here.
+        self.globs = []      # (pattern, recipients) for paths below here.
+
+class RouteTrie(object):
+    """ Recipients by path. Patterns without wildcards are path prefixes,
+    kept along a trie of path components. Patterns with wildcards are
+    matched against the complete path with fnmatch, but only tried for
+    paths below the node of their leading literal components. """
+
+    def __init__(self):
+        self.root = RouteNode()
+
+    def add(self, pattern, recipients):
+        node = self.root
+        parts = [part for part in pattern.split("/") if part]
+
+        for part in parts:
+            if re.search(r"[*?[]", part):
+                node.globs.append(("/".join(parts), recipients))
+                return
+
+            node = node.children.setdefault(part, RouteNode())
+
+        node.recipients.extend(recipients)
+
+    def match(self, path):
+        # Returns the set of recipients for a path.
+        recipients = set()
+        node = self.root
+
+        for part in path.split("/") + [None]:
+            recipients.update(node.recipients)
+
+            for (pattern, addrs) in node.globs:
+                if fnmatch.fnmatchcase(path, pattern):
+                    recipients.update(addrs)
+
+            node = part and node.children.get(part)
+            if not node:
+                break
+
+        return recipients
+
+Routes = {} # File name to (modification time, RouteTrie).
+
+def loadRoutes(file):
+    mtime = os.path.getmtime(file)
+
+    if file not in Routes or Routes[file][0] != mtime:
+        trie = RouteTrie()
+
+        for line in open(file):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            m = line.split(None, 1)
+            if len(m) == 2:
+                trie.add(m[0], [r for r in re.split(r"[,|\s]+", m[1]) if r])
+
+        Routes[file] = (mtime, trie)
+
+    return Routes[file][1]
+
+# Returns the recipients for the mail about a revision: those the routing file
+# assigns to the paths it changes, or the mailing list if there's no routing
+# file or none of its patterns match.
+def routeRecipients(rev):
+    if not Config.routes or not os.path.exists(Config.routes):
+        return Config.mailinglist
+
+    trie = loadRoutes(Config.routes)
+    recipients = set()
+
+    for path in Objects.paths(rev):
+        recipients |= trie.match(path)
+
+    return recipients and ", ".join(sorted(recipients)) or Config.mailinglist
+
 class GitNotifierConfig(object):
     email_regexp = re.compile(r"^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,4}$")
 
     Options = [
     # Name, argument, default, help,
     ("allchanges", True, set(), "branches for which *all* changes are to be reported"),
+    ("cachesize", True, 32 * ONE_MB_IN_BYTES, "size limit of the cache of rendered mails (0 disables it)"),
+    ("daemon", True, None, "serve pushes forwarded by git-notifier-client over this Unix socket"),
     ("debug", False, False, "enable debug output"),
+    ("deliver", False, False, "deliver the updates queued by --spool"),
     ("diff", True, None, "mail out diffs between two revisions"),
+    ("digest", True, 500, "report pushes of more new revisions than this as digest mails (0 disables)"),
     ("emailprefix", True, "[git]", "Subject prefix for mails"),
+    ("generated", True, None, "comma-separated patterns of generated files to leave out of diffs"),
     ("hostname", True, socket.gethostname(), "host where the repository is hosted"),
+    ("incremental", False, False, "compute new revisions from the ref updates given on stdin"),
+    ("inlinediffsize", True, ONE_MB_IN_BYTES / 8, "attach larger diffs compressed, showing only a preview (0 disables)"),
     ("log", True, "%s.log" % Name, "set log output"),
+    ("mailburst", True, 10, "number of mails sent back-to-back before --mailrate applies"),
     ("mailinglist", True, whoami, "destination address for mails"),
+    ("mailrate", True, 0, "maximum number of mails sent per minute (0 for no limit)"),
     ("manual", True, None, "notifiy for a manually given set of revisions"),
     ("maxdiffsize", True, ONE_MB_IN_BYTES, "limit the size of diffs in mails (KB)"),
+    ("maxfilediffsize", True, ONE_MB_IN_BYTES / 4, "limit the size of each file's diff in mails"),
+    ("metrics", True, None, "append timings of each run's phases to this file, as JSON lines"),
     ("noupdate", False, False, "do not update the state file"),
+    ("parallel", True, 1, "number of processes rendering mails concurrently"),
+    ("profile", True, None, "write a profile of the run to this file"),
     ("repouri", True, None, "full URI for the repository"),
     ("sender", True, sender, "sender address for mails"),
+    ("spool", False, False, "queue updates and deliver mails from a background process"),
     ("link", True, None, "Link to insert into mail, %s will be replaced with revision"),
     ("updateonly", False, False, "update state file only, no mails"),
     ("users", True, None, "location of a user-to-email mapping file"),
     ("replyto", True, None, "email address for reply-to header"),
+    ("routes", True, None, "location of a file routing mails by the paths a revision changes"),
+    ("verify", False, False, "with --incremental, cross-check against a full scan"),
     ]
             
     def __init__(self, provider):
@@ -576,6 +2930,18 @@ class GitNotifierConfig(object):
         self._config = {}
         self.use_sendmail = False
         self.maxdiffsize = ONE_MB_IN_BYTES
+        self.maxfilediffsize = ONE_MB_IN_BYTES / 4
+        self.generated = None
+        self.cachesize = 0
+        self.default_sender = True
+        self.digest = 0
+        self.debug = False
+        self.metrics = None
+        self.routes = None
+        self.inlinediffsize = 0
+        self.mailrate = 0
+        self.mailburst = 10
+        self._pacer = None
 
     def __getitem__(self, value):
         return self._config[value]
@@ -602,6 +2968,7 @@ class GitNotifierConfig(object):
         self.optional(SMTP_PORT)
         self.optional(SMTP_SENDER)
         self.optional(SMTP_SENDER_PASSWORD)
+        self.optional(SMTP_MAX_MESSAGES)
         self.required(MAILINGLIST)
         self.recipients = self._config[MAILINGLIST]
         return self
@@ -623,6 +2990,7 @@ class GitNotifierConfig(object):
             if os.path.exists(users):
                 self.users = users
 
+        self.default_sender = (self.sender == sender)
         self.readUsers()
 
     def parseArgs(self, args):
@@ -662,49 +3030,51 @@ class GitNotifierConfig(object):
 
     def readUsers(self):
         if self.users and os.path.exists(self.users):
-            for line in open(self.users):
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
+            self.sender = loadUsers(self.users).get(self.sender, self.sender)
+
+    # Returns the rate limiter for sending mails.
+    def pacer(self):
+        if not self._pacer:
+            self._pacer = TokenBucket(self.mailrate / 60.0, self.mailburst)
 
-                m = line.split()
+        return self._pacer
 
-                if self.sender == m[0]:
-                    self.sender = " ".join(m[1:])
-                    break
+    def setUser(self, user):
+        # Makes *user* the one who pushed, unless a sender is configured.
+        if self.default_sender:
+            self.sender = user
+            self.readUsers()
 
     def _git_config(self, key, default):
-        cfg = git(["config hooks.%s" % key])
-        if cfg:
-            return cfg[0]
-        else:
-            return default
+        return self._provider.get("hooks.%s" % key) or default
 
 if __name__ == "__main__":
-    Config = config = GitNotifierConfig(GitConfigProvider())
-    config.load_args(sys.argv[1:])
-    config.get_config_variables()
-        
+    start = time.time()
+
+    with phase("config"):
+        Config = config = GitNotifierConfig(GitConfigProvider())
+        config.load_args(sys.argv[1:])
+
+    if Config.daemon:
+        serveDaemon(Config.daemon)
+
+    with phase("config"):
+        config.get_config_variables()
+
+    atexit.register(writeMetrics, start)
+
+    if Config.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(writeProfile, profiler, Config.profile)
+
     log("Running for %s" % os.getcwd())
 
     if Config.debug:
         for (name, arg, default, help) in Config.Options:
             print >>sys.stderr, "[Option %s: %s]" % (name, Config.__dict__[name])
    
-    mailer = Mailer(config[SMTP_HOST], config[SMTP_PORT],
-                    config[SMTP_SENDER], config[SMTP_SENDER_PASSWORD],
-                    config[MAILINGLIST])
-
-    cache = State()
-
-    if os.path.exists(CacheFile):
-        cache.readFrom(CacheFile)
-        report = (not Config.updateonly)
-    else:
-        log("Initial run. Not generating any mails, just recording current state.")
-        report = False
-
-    current = State.getCurrent()
+    mailer = makeMailer(config)
 
     if Config.diff:
         # Manual diff mode. The argument must be of the form "[old-rev..]new-rev".
@@ -714,8 +3084,9 @@ if __name__ == "__main__":
         else:
             path = ("%s~1" % path[0], path[1])
 
-        revs = git(["rev-list", "--reverse --date-order", path[1], "^%s" % path[0]])
+        revs = git(["rev-list", "--reverse", "--date-order", path[1], "^%s" % path[0]])
 
+        current = State()
         diffPath("<manual-diff>", revs)
 
         sys.exit(0)
@@ -726,59 +3097,23 @@ if __name__ == "__main__":
         if len(path) == 1:
             path = ("%s~1" % path[0], path[0])
 
-        revs = git(["rev-list", "--reverse --date-order", path[1], "^%s" % path[0]])
-        reportPath(current, revs, force=True)
+        revs = git(["rev-list", "--reverse", "--date-order", path[1], "^%s" % path[0]])
+        reportPath(State(), revs, force=True)
 
         sys.exit(0)
 
-    if report:
-        theReport = GitReport()
-        # Check for changes to the set of heads.
-        old = set(cache.heads.keys())
-        new = set(current.heads.keys())
-
-        for head in (new - old):
-            entryAdded("branch", head, current.heads[head])
-
-        for head in (old - new):
-            entryDeleted("branch", head)
+    if Config.deliver:
+        deliverSpool()
 
-        stable_heads = new & old
+    elif Config.spool:
+        spoolUpdates(readUpdates(sys.stdin))
+        startDelivery([arg for arg in sys.argv[1:] if arg != "--spool"])
 
-        Config.allchanges = Config.allchanges & stable_heads
+    elif Config.incremental:
+        processUpdates(readUpdates(sys.stdin))
 
-        # Check tags.
-        old = set(cache.tags.keys())
-        new = set(current.tags.keys())
-
-        for tag in (new - old):
-            entryAdded("tag", tag, current.tags[tag])
-
-        for tag in (old - new):
-            entryDeleted("tag", tag)
-
-        # Notify for unreported commits.
-        old = set(cache.revs)
-        new = set(current.revs)
-        new_revs = (new - old)
-        reportPath(current, new_revs)
-
-        # Do reports for the heads we want to see everything for.
-        for head in stable_heads:
-            old_rev = cache.heads[head]
-            new_rev = current.heads[head]
-            path = git(["rev-list", "--reverse --date-order", new_rev, "^%s" % old_rev])
-
-            if head in Config.allchanges:
-                # Want to see all commits for this head, even if already reported
-                # in the past for some other. So we record these separately.
-                reportPath(current, path, subject_head=head)
-            else:
-                # Just send a summary for heads that now include some new stuff.
-                if len(set(path) - new_revs):
-                    headMoved(head, path)
-
-    if not Config.noupdate:
-        current.writeTo(CacheFile)
+    else:
+        processUpdates()
 
-    deleteTmps()
+    mailer.close()
+    Objects.close()
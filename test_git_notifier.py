@@ -1,5 +1,19 @@
+import asyncore
+import email.utils
+import gzip
+import json
+import os
+import resource
+import shutil
+import smtpd
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import git_notifier
+from cStringIO import StringIO
 
 diffexample = """
 diff --git a/scratchpad/gitnotifier.txt b/scratchpad/gitnotifier.txt
@@ -23,7 +37,121 @@ class TestGitParser(unittest.TestCase):
     def test_parse(self):
         html = git_notifier.patch2html(diffexample)
         self.assertTrue(html)
+
+    def test_html_lines(self):
+        html = git_notifier.patch2html(diffexample)
+        self.assertTrue('<span class="gh">@@ -1,5 +1,2 @@</span>' in html)
+        self.assertTrue('<span class="gd">-more edits</span>' in html)
+        self.assertTrue('<span class="gh"> some more..</span>' in html)
+        self.assertFalse("diff --git" in html)
+
+    def test_html_escaping(self):
+        html = git_notifier.patch2html("@@ -1 +1 @@\n-if (a < b && c)\n+if (a <= b)\n", title="<b>")
+        self.assertTrue('<span class="gd">-if (a &lt; b<span class="x"> &amp;&amp; c</span>)</span>' in html)
+        self.assertTrue('<span class="gi">+if (a &lt;<span class="x">=</span> b)</span>' in html)
+        self.assertTrue("<title>&lt;b&gt;</title>" in html)
+
+    def test_html_streaming(self):
+        lines = iter(diffexample.split("\n"))
+        html = git_notifier.iterPatch2html(lines)
+        html.next() # Header.
+        html.next() # Start of the hunk, having read its "@@" line.
+        self.assertEquals(" test test", lines.next())
         
+class TestIntraline(unittest.TestCase):
+
+    def test_no_newline_inside_hunk(self):
+        html = git_notifier.patch2html("@@ -1 +1 @@\n-x\n\\ No newline at end of file\n+y\n")
+        self.assertTrue('<span class="gi">+y</span>' in html)
+        self.assertEquals(1, html.count("<pre>"))
+
+    def test_diff_words(self):
+        import difflib
+        import random
+        rnd = random.Random(42)
+
+        for i in range(200):
+            a = [rnd.choice("abc") for j in range(rnd.randint(0, 12))]
+            b = [rnd.choice("abc") for j in range(rnd.randint(0, 12))]
+            ((removed, added), cost) = git_notifier.diffWords(a, b, 100000)
+            self.assertEquals([w for (j, w) in enumerate(a) if j not in removed],
+                              [w for (j, w) in enumerate(b) if j not in added])
+            common = sum(block.size for block in difflib.SequenceMatcher(None, a, b, False).get_matching_blocks())
+            self.assertTrue(len(a) - len(removed) >= common)
+
+    def test_budget(self):
+        (old, new) = ("-" + " ".join("w%d" % i for i in range(500)), "+" + " ".join("v%d" % i for i in range(500)))
+        self.assertEquals(None, git_notifier.diffWords(old.split(), new.split(), 1000))
+
+        highlighter = git_notifier.HunkHighlighter(budget=50)
+        chunks = highlighter.add("-foo(1)") + highlighter.add("+foo(2)") + highlighter.add(old) + highlighter.add(new)
+        chunks += highlighter.flush()
+        self.assertEquals('<span class="gd">-foo(<span class="x">1</span>)</span>\n', chunks[0])
+        self.assertEquals('<span class="gd">%s</span>\n' % old, chunks[2])
+        self.assertEquals('<span class="gi">%s</span>\n' % new, chunks[3])
+
+multidiff = """ a | 2 +-
+ b | 1 -
+diff --git a/a b/a
+index 1111111..2222222 100644
+--- a/a
++++ b/a
+@@ -1,2 +1,2 @@
+ same
+-old
+\\ No newline at end of file
++new
+\\ No newline at end of file
+@@ -10 +10,0 @@
+-gone
+diff --git a/b b/b
+deleted file mode 100644
+index 3333333..0000000
+--- a/b
++++ /dev/null
+@@ -1 +0,0 @@
+-b
+diff --git a/c b/d
+similarity index 100%
+rename from c
+rename to d
+"""
+
+class TestPatchParser(unittest.TestCase):
+
+    def test_patches(self):
+        patches = git_notifier.GitDiffParser().patches(multidiff)
+        self.assertEquals(["a", "b", "d"], [p.path for p in patches])
+        self.assertEquals(["modify", "delete", "rename"], [p.type for p in patches])
+        self.assertEquals(("c", "d"), (patches[2].source, patches[2].target))
+        self.assertEquals(None, patches[1].target)
+
+        hunks = patches[0].hunks
+        self.assertEquals(2, len(hunks))
+        self.assertEquals((1, 2, 1, 2), (hunks[0].start_src, hunks[0].lines_src, hunks[0].start_tgt, hunks[0].lines_tgt))
+        self.assertEquals((10, 1, 10, 0), (hunks[1].start_src, hunks[1].lines_src, hunks[1].start_tgt, hunks[1].lines_tgt))
+        self.assertEquals(["@@ -10 +10,0 @@", "-gone"], hunks[1].text)
+        self.assertEquals(multidiff.index("diff --git a/b"), patches[0].end)
+        self.assertEquals(len(multidiff), patches[2].end)
+
+    def test_truncate(self):
+        patches = git_notifier.GitDiffParser().patches(multidiff)
+        limit = patches[0].hunks[1].start - patches[0].start
+        (data, truncated) = git_notifier.truncatePatches(multidiff, limit)
+        self.assertEquals(["a"], truncated)
+        self.assertFalse("-gone" in data)
+        self.assertTrue("+new" in data)
+        self.assertTrue(data.endswith(multidiff[patches[1].start:]))
+
+    def test_preview(self):
+        patches = git_notifier.GitDiffParser().patches(multidiff)
+        preview = git_notifier.previewPatches
+
+        self.assertEquals(multidiff[:patches[0].start], preview(multidiff, 10))
+        self.assertEquals(multidiff[:patches[0].hunks[0].end], preview(multidiff, patches[0].hunks[1].end - 1))
+        self.assertEquals(multidiff[:patches[1].end], preview(multidiff, patches[2].end - 1))
+        self.assertEquals(multidiff, preview(multidiff, len(multidiff)))
+
 class FakeProvider(object):
 
     def get(self, varname):
@@ -66,9 +194,86 @@ class TestConfig(unittest.TestCase):
         self.assertSplitEmails(input, expected)
 
 
+class FakeSMTP(object):
+    """ Stands in for smtplib.SMTP, recording sessions and messages. """
+
+    sessions = []
+    fail = 0 # Number of upcoming sendmail() calls to fail.
+
+    def __init__(self, host, port):
+        self.messages = []
+        self.recipients = []
+        self.closed = False
+        FakeSMTP.sessions.append(self)
+
+    def sendmail(self, sender, recipients, message):
+        if FakeSMTP.fail:
+            FakeSMTP.fail -= 1
+            raise git_notifier.smtplib.SMTPServerDisconnected("gone")
+
+        self.messages.append(message)
+        self.recipients.append(recipients)
+
+    def quit(self):
+        self.closed = True
+
+class TestMailer(unittest.TestCase):
+
+    def setUp(self):
+        self.config = git_notifier.Config
+        git_notifier.Config = git_notifier.GitNotifierConfig(FakeProvider())
+        git_notifier.Config.log = open(os.devnull, "w")
+        self.smtp = git_notifier.smtplib.SMTP
+        git_notifier.smtplib.SMTP = FakeSMTP
+        FakeSMTP.sessions = []
+        FakeSMTP.fail = 0
+
+    def tearDown(self):
+        git_notifier.Config = self.config
+        git_notifier.smtplib.SMTP = self.smtp
+
+    def send(self, mailer, count):
+        for i in range(count):
+            mailer.send("sender", ["recipient"], "message %d" % i)
+
+    def test_session_reuse(self):
+        mailer = git_notifier.Mailer("localhost", 25, "sender", "", ["recipient"], max_messages=2)
+        self.send(mailer, 5)
+        mailer.close()
+        self.assertEquals([2, 2, 1], [len(s.messages) for s in FakeSMTP.sessions])
+        self.assertTrue(all(s.closed for s in FakeSMTP.sessions))
+
+    def test_reconnect(self):
+        mailer = git_notifier.Mailer("localhost", 25, "sender", "", ["recipient"])
+        self.send(mailer, 2)
+        FakeSMTP.fail = 1
+        self.send(mailer, 2)
+        self.assertEquals([2, 2], [len(s.messages) for s in FakeSMTP.sessions])
+
+        FakeSMTP.fail = 2
+        self.assertRaises(git_notifier.smtplib.SMTPServerDisconnected, self.send, mailer, 1)
+
+    def test_display_names(self):
+        git_notifier.Config.parseArgs(["--mailinglist", '"Git Commits" <commits@example.com>, Dev <dev@example.com>'])
+        git_notifier.Config.log = open(os.devnull, "w")
+        mailer = git_notifier.mailer
+        git_notifier.mailer = git_notifier.Mailer("localhost", 25, "sender", "", [])
+
+        try:
+            git_notifier.sendMail(git_notifier.generateMailHeader(git_notifier.Config, "subject"))
+        finally:
+            git_notifier.mailer = mailer
+
+        self.assertEquals([["commits@example.com", "dev@example.com"]], FakeSMTP.sessions[0].recipients)
+
 class TestMail(unittest.TestCase):
 
-    def get(self, key):        
+    def get(self, key):
+        # Leaves the numeric and boolean options at their defaults.
+        for (name, arg, default, help) in git_notifier.GitNotifierConfig.Options:
+            if key == "hooks.%s" % name and isinstance(default, int):
+                return None
+
         return "some_value"
     
     def test_mail_creation(self):
@@ -76,3 +281,1125 @@ class TestMail(unittest.TestCase):
         cfg.get_config_variables() 
         cfg.parseArgs([])
         git_notifier.generateMailHeader(cfg,"Subject")
+
+
+class TestMailOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.config = git_notifier.Config
+        git_notifier.Config = git_notifier.GitNotifierConfig(FakeProvider())
+        git_notifier.Config.parseArgs(["--mailinglist", "list@example.com"])
+
+    def tearDown(self):
+        git_notifier.Config = self.config
+
+    def test_sequence(self):
+        sequence = git_notifier.MailSequence()
+        mails = [git_notifier.generateMailHeader(git_notifier.Config, "mail %d" % i) for i in range(4)]
+
+        for mail in mails[:3]:
+            sequence.stamp(mail)
+
+        sequence.startPush()
+        sequence.stamp(mails[3])
+
+        dates = [email.utils.mktime_tz(email.utils.parsedate_tz(mail.mime_text["Date"])) for mail in mails]
+        self.assertEquals(sorted(dates), dates)
+        self.assertTrue(dates[-1] <= time.time())
+
+        sequence.last = int(time.time()) + 60 # The clock went back.
+        mail = git_notifier.generateMailHeader(git_notifier.Config, "later")
+        sequence.stamp(mail)
+        self.assertEquals(sequence.last, email.utils.mktime_tz(email.utils.parsedate_tz(mail.mime_text["Date"])))
+
+        ids = [mail.mime_text["Message-ID"] for mail in mails]
+        self.assertEquals(4, len(set(ids)))
+        self.assertEquals([None, ids[0], ids[1], None], [mail.mime_text["In-Reply-To"] for mail in mails])
+        self.assertEquals("%s %s" % (ids[0], ids[1]), mails[2].mime_text["References"])
+
+    def test_long_thread(self):
+        sequence = git_notifier.MailSequence()
+        mails = [git_notifier.generateMailHeader(git_notifier.Config, "mail %d" % i) for i in range(30)]
+
+        for mail in mails:
+            sequence.stamp(mail)
+
+        ids = [mail.mime_text["Message-ID"] for mail in mails]
+        self.assertEquals(ids[28], mails[29].mime_text["In-Reply-To"])
+        refs = mails[29].mime_text["References"].split()
+        self.assertEquals([ids[0]] + ids[29 - git_notifier.MailSequence.MaxReferences + 1:29], refs)
+
+    def test_token_bucket(self):
+        clock = [100.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            clock[0] += seconds
+
+        bucket = git_notifier.TokenBucket(0.5, 2, clock=lambda: clock[0], sleep=sleep)
+
+        for i in range(4):
+            bucket.take()
+
+        self.assertEquals([2.0, 2.0], waits)
+
+        clock[0] += 60
+        bucket.take()
+        bucket.take()
+        self.assertEquals(2, len(waits))
+
+        unlimited = git_notifier.TokenBucket(0, 1, sleep=sleep)
+
+        for i in range(100):
+            unlimited.take()
+
+        self.assertEquals(2, len(waits))
+
+class GitRepoTestCase(unittest.TestCase):
+    """ Runs each test inside a fresh scratch repository. """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp(prefix="git-notifier-test-")
+        os.chdir(self.dir)
+        self.run_git("init", "-q")
+        self.run_git("config", "user.name", "Test User")
+        self.run_git("config", "user.email", "test@example.com")
+        self.config = git_notifier.Config
+        self.send_mail = git_notifier.sendMail
+        git_notifier.Config = git_notifier.GitNotifierConfig(FakeProvider())
+        git_notifier.Config.log = open(os.devnull, "w")
+
+    def tearDown(self):
+        git_notifier.Config = self.config
+        git_notifier.sendMail = self.send_mail
+        git_notifier.Objects.close()
+        git_notifier.Branches = git_notifier.BranchIndex()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def configure(self, *args):
+        # Parses options and captures the mails sent instead of sending them.
+        log = git_notifier.Config.log
+        git_notifier.Config.parseArgs(list(args))
+        git_notifier.Config.log = log
+        self.mails = []
+        git_notifier.sendMail = self.mails.append
+
+    def run_git(self, *args):
+        return subprocess.check_output(("git",) + args).strip()
+
+    def commit(self, msg, fname="file"):
+        out = open(fname, "a")
+        print >>out, msg
+        out.close()
+        self.run_git("add", fname)
+        self.run_git("commit", "-q", "-m", msg)
+        return self.run_git("rev-parse", "HEAD")
+
+    def rev(self, ref):
+        return self.run_git("rev-parse", "--verify", "-q", ref)
+
+class TestIncrementalState(GitRepoTestCase):
+
+    def refs(self):
+        refs = {}
+        for line in self.run_git("for-each-ref", "--format=%(objectname) %(refname)").split("\n"):
+            if line:
+                (rev, ref) = line.split()
+                refs[ref] = rev
+        return refs
+
+    def updates(self, before, after):
+        updates = []
+        for ref in set(before) | set(after):
+            old = before.get(ref, git_notifier.ZeroRev)
+            new = after.get(ref, git_notifier.ZeroRev)
+            if old != new:
+                updates.append((old, new, ref))
+        return updates
+
+    def assertMatchesFullScan(self, cache, before):
+        current = git_notifier.State.getIncremental(cache, self.updates(before, self.refs()))
+        full = git_notifier.State.getCurrent()
+        self.assertEquals(full.heads, current.heads)
+        self.assertEquals(full.tags, current.tags)
+        self.assertEquals(full.revs, current.revs)
+        self.assertEquals(full.newRevisions(cache), current.newRevisions(cache))
+        return current
+
+    def test_incremental_matches_full_scan(self):
+        self.commit("one")
+        cache = git_notifier.State.getCurrent()
+        before = self.refs()
+
+        self.commit("two")
+        self.run_git("checkout", "-q", "-b", "topic")
+        topic = self.commit("three", fname="other")
+        self.run_git("tag", "-a", "-m", "release", "v1.0")
+        self.run_git("tag", "lightweight")
+        self.run_git("checkout", "-q", "master")
+
+        current = self.assertMatchesFullScan(cache, before)
+        self.assertTrue(topic in current.added)
+        self.assertEquals(3, len(current.revs))
+
+    def test_incremental_deletes_and_rewinds(self):
+        self.commit("one")
+        self.run_git("checkout", "-q", "-b", "topic")
+        self.commit("two")
+        self.run_git("tag", "-a", "-m", "release", "v1.0")
+        self.run_git("checkout", "-q", "master")
+        self.commit("three")
+        cache = git_notifier.State.getCurrent()
+        before = self.refs()
+
+        self.run_git("branch", "-q", "-D", "topic")
+        self.run_git("tag", "-d", "v1.0")
+        self.run_git("reset", "-q", "--hard", "HEAD~1")
+
+        current = self.assertMatchesFullScan(cache, before)
+        self.assertEquals(set(), current.added)
+
+    def test_out_of_order_updates(self):
+        first = self.commit("one")
+        self.configure("--incremental")
+        git_notifier.processUpdates()
+
+        second = self.commit("two")
+        third = self.commit("three")
+
+        # The hook for the second push runs before the one for the first.
+        self.assertEquals(None, git_notifier.State.getIncremental(git_notifier.loadState(),
+                                                                  [(second, third, "refs/heads/master")]))
+
+        git_notifier.processUpdates([(second, third, "refs/heads/master")])
+        state = git_notifier.loadState()
+        self.assertEquals(third, state.heads["master"])
+        self.assertEquals(2, len(self.mails))
+
+        git_notifier.processUpdates([(first, second, "refs/heads/master")])
+        self.assertEquals(2, len(self.mails))
+        self.assertEquals(third, git_notifier.loadState().heads["master"])
+
+    def test_lightweight_tag_update(self):
+        self.commit("one")
+        self.run_git("tag", "light")
+        cache = git_notifier.State.getCurrent()
+        old = self.rev("light")
+        new = self.commit("two")
+        self.run_git("tag", "-f", "light")
+
+        current = git_notifier.State.getIncremental(cache, [(old, new, "refs/tags/light")])
+        self.assertNotEquals(None, current)
+
+    def test_read_updates(self):
+        lines = ["%s %s refs/heads/master\n" % (git_notifier.ZeroRev, "a" * 40), "\n"]
+        self.assertEquals([(git_notifier.ZeroRev, "a" * 40, "refs/heads/master")],
+                          git_notifier.readUpdates(lines))
+
+class TestStateFile(GitRepoTestCase):
+
+    def test_roundtrip(self):
+        self.commit("one")
+        self.run_git("tag", "-a", "-m", "release", "v1.0")
+        self.commit("two")
+        state = git_notifier.State.getCurrent()
+        state.writeTo("state.dat")
+
+        cache = git_notifier.State()
+        cache.readFrom("state.dat")
+        self.assertEquals(state.heads, cache.heads)
+        self.assertEquals(state.tags, cache.tags)
+        self.assertEquals(set(state.revs), set(cache.revs))
+        self.assertTrue(self.rev("HEAD") in cache.revs)
+        self.assertFalse("f" * 40 in cache.revs)
+
+    def test_migrate_text_format(self):
+        revs = sorted(["%040x" % i for i in (1, 7, 42)])
+        out = open("state.dat", "w")
+        print >>out, "head master", revs[0]
+        print >>out, "tag v1.0", revs[1]
+        for rev in revs:
+            print >>out, "rev", rev
+        out.close()
+
+        cache = git_notifier.State()
+        cache.readFrom("state.dat")
+        cache.writeTo("state.dat")
+        self.assertEquals(git_notifier.StateMagic, open("state.dat").read(4))
+
+        migrated = git_notifier.State()
+        migrated.readFrom("state.dat")
+        self.assertEquals({"master": revs[0]}, migrated.heads)
+        self.assertEquals({"v1.0": revs[1]}, migrated.tags)
+        self.assertEquals(revs, list(migrated.revs))
+
+    def test_store_updates(self):
+        state = git_notifier.State()
+        state.revs.update(["%040x" % i for i in range(10)])
+        state.writeTo("state.dat")
+        state.readFrom("state.dat")
+
+        revs = state.revs.copy()
+        revs.difference_update(["%040x" % 3, "%040x" % 42])
+        revs.update(["%040x" % 3, "%040x" % 11])
+        revs.discard("%040x" % 0)
+        self.assertEquals(10, len(revs))
+        self.assertEquals(set(["%040x" % i for i in range(1, 10) + [11]]), set(revs))
+        self.assertEquals(10, len(state.revs))
+
+class TestStateJournal(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.commit("one")
+        self.initial = git_notifier.State.getCurrent()
+        self.initial.saveTo("state.dat", git_notifier.State())
+
+    def load(self):
+        cache = git_notifier.State()
+        cache.readFrom("state.dat")
+        return cache
+
+    def push(self, msg):
+        cache = self.load()
+        self.commit(msg)
+        current = git_notifier.State.getCurrent()
+        current.saveTo("state.dat", cache)
+        return current
+
+    def test_append_and_replay(self):
+        snapshot = open("state.dat").read()
+        self.push("two")
+        self.run_git("checkout", "-q", "-b", "topic")
+        current = self.push("three")
+
+        self.assertEquals(snapshot, open("state.dat").read())
+        cache = self.load()
+        self.assertEquals(2, cache.journal.records)
+        self.assertEquals(current.heads, cache.heads)
+        self.assertEquals(set(current.revs), set(cache.revs))
+        self.assertEquals(set(), git_notifier.State.getCurrent().newRevisions(cache))
+
+    def test_torn_record(self):
+        current = self.push("two")
+        size = os.path.getsize("state.dat.journal")
+        out = open("state.dat.journal", "ab")
+        out.write("J 100 00000000\nhead master")
+        out.close()
+
+        cache = self.load()
+        self.assertEquals(1, cache.journal.records)
+        self.assertEquals(current.heads, cache.heads)
+        self.assertEquals(size, os.path.getsize("state.dat.journal"))
+
+    def test_compaction(self):
+        git_notifier.StateJournal.MaxRecords = 2
+        try:
+            self.push("two")
+            current = self.push("three")
+        finally:
+            git_notifier.StateJournal.MaxRecords = 1000
+
+        self.assertEquals(0, os.path.getsize("state.dat.journal"))
+        cache = self.load()
+        self.assertEquals(set(current.revs), set(cache.revs))
+        self.assertEquals(3, len(cache.revs))
+
+class TestRefs(GitRepoTestCase):
+
+    def count_git_calls(self, func):
+        calls = []
+        popen = subprocess.Popen
+
+        def counting(*args, **kwargs):
+            calls.append(args)
+            return popen(*args, **kwargs)
+
+        subprocess.Popen = counting
+        try:
+            return (func(), len(calls))
+        finally:
+            subprocess.Popen = popen
+
+    def test_refs(self):
+        self.commit("one")
+        self.run_git("tag", "-a", "-m", "release", "v1.0")
+        self.run_git("tag", "lightweight")
+        self.run_git("branch", "topic")
+
+        (state, calls) = self.count_git_calls(git_notifier.State.getCurrent)
+        self.assertEquals({"master": self.rev("master"), "topic": self.rev("topic")}, state.heads)
+        self.assertEquals({"v1.0": self.rev("v1.0")}, state.tags)
+
+        for i in range(10):
+            self.run_git("tag", "-a", "-m", "release", "v2.%d" % i)
+
+        (state, more_calls) = self.count_git_calls(git_notifier.State.getCurrent)
+        self.assertEquals(11, len(state.tags))
+        self.assertEquals(calls, more_calls)
+
+class TestObjectReader(GitRepoTestCase):
+
+    def test_commit(self):
+        self.commit("one")
+        self.run_git("commit", "-q", "--allow-empty", "-m", "Multi-line\nsubject  here\n\nBody [nodiff]")
+        rev = self.rev("HEAD")
+
+        reader = git_notifier.ObjectReader()
+        try:
+            commit = reader.commit(rev)
+            self.assertEquals(self.run_git("show", "-s", "--format=%s", rev), commit.subject)
+            self.assertEquals(self.run_git("show", "-s", "--format=%an <%ae>", rev), commit.author)
+            self.assertEquals(self.run_git("show", "-s", "--format=%ad", rev), commit.date)
+            self.assertEquals([self.rev("HEAD~1")], commit.parents)
+            self.assertTrue(commit.nodiff())
+            self.assertFalse(commit.nomail())
+            self.assertEquals(self.run_git("show", "-s", "--format=%s (%h)", rev), reader.describe(rev))
+        finally:
+            reader.close()
+
+    def test_prefetch(self):
+        self.run_git("commit", "-q", "--allow-empty", "-m", "root")
+        self.commit("one")
+        self.run_git("commit", "-q", "--allow-empty", "-m", "Multi-line\nsubject\n\nBody [nomail]")
+        revs = self.run_git("rev-list", "HEAD").split()
+
+        reader = git_notifier.ObjectReader()
+        del git_notifier.GitCalls[:]
+        try:
+            reader.prefetch(revs)
+
+            for rev in revs:
+                commit = reader.commit(rev)
+                self.assertEquals(self.run_git("show", "-s", "--format=%s (%h)", rev), reader.describe(rev))
+                self.assertEquals(self.run_git("show", "-s", "--format=%an <%ae>", rev), commit.author)
+                self.assertEquals(self.run_git("show", "-s", "--format=%ad", rev), commit.date)
+                self.assertEquals(self.run_git("show", "-s", "--format=%P", rev).split(), commit.parents)
+
+            self.assertTrue(reader.commit(revs[0]).nomail())
+            self.assertEquals([["log"]], [call.args[:1] for call in git_notifier.GitCalls])
+        finally:
+            reader.close()
+
+class TestGitConfig(GitRepoTestCase):
+
+    def test_snapshot(self):
+        self.run_git("config", "hooks.smtp-host", "mail.example.com")
+        self.run_git("config", "hooks.maxDiffSize", "2048")
+        self.run_git("config", "hooks.emailprefix", "[one]")
+        self.run_git("config", "--add", "hooks.emailprefix", "[two]")
+        self.run_git("config", "hooks.users", "")
+
+        del git_notifier.GitCalls[:]
+        cfg = git_notifier.GitNotifierConfig(git_notifier.GitConfigProvider())
+        cfg.parseArgs([])
+        cfg.optional(git_notifier.SMTP_HOST)
+        cfg.optional(git_notifier.SMTP_PORT)
+
+        self.assertEquals(1, len(git_notifier.GitCalls))
+        self.assertEquals(2048, cfg.maxdiffsize)
+        self.assertEquals("[two]", cfg.emailprefix)
+        self.assertEquals(None, cfg.users)
+        self.assertEquals(1, cfg.parallel)
+        self.assertEquals("mail.example.com", cfg[git_notifier.SMTP_HOST])
+        self.assertEquals("", cfg[git_notifier.SMTP_PORT])
+
+    def test_invalid(self):
+        self.run_git("config", "hooks.parallel", "many")
+        cfg = git_notifier.GitNotifierConfig(git_notifier.GitConfigProvider())
+        self.assertRaises(ValueError, cfg.parseArgs, [])
+        self.assertRaises(git_notifier.ConfigValueError, cfg.required, git_notifier.SMTP_HOST)
+
+class TestBranchIndex(GitRepoTestCase):
+
+    def branch_contains(self, rev):
+        return [line.split()[-1] for line in self.run_git("branch", "--contains=%s" % rev).split("\n")]
+
+    def test_matches_branch_contains(self):
+        self.commit("one")
+        self.run_git("branch", "stable")
+        self.run_git("branch", "old-topic")
+        cache = git_notifier.State.getCurrent()
+
+        two = self.commit("two")
+        self.run_git("checkout", "-q", "-b", "topic")
+        three = self.commit("three", fname="other")
+        self.run_git("checkout", "-q", "master")
+        self.run_git("merge", "-q", "--no-ff", "-m", "merge", "topic")
+        merge = self.rev("HEAD")
+        self.run_git("checkout", "-q", "--detach")
+        tagged = self.commit("four")
+        self.run_git("tag", "-a", "-m", "release", "v1.0")
+        self.run_git("checkout", "-q", "master")
+
+        current = git_notifier.State.getCurrent()
+        new_revs = current.newRevisions(cache)
+        self.assertEquals(set([two, three, merge, tagged]), new_revs)
+
+        index = git_notifier.BranchIndex()
+        index.build(cache, current, new_revs)
+
+        for rev in (two, three, merge):
+            self.assertEquals(self.branch_contains(rev), index.lookup(rev))
+
+        self.assertEquals([], index.lookup(tagged))
+        self.assertEquals(None, index.lookup(self.rev("stable")))
+        self.assertEquals(["master", "old-topic", "stable", "topic"], index.contains(self.rev("stable")))
+
+class TestGitStream(GitRepoTestCase):
+
+    def test_records_calls(self):
+        rev = self.commit("one")
+        del git_notifier.GitCalls[:]
+
+        self.assertEquals([rev], git_notifier.git(["rev-list", "HEAD"]))
+        self.assertEquals([rev], list(git_notifier.gitStream(["cat-file", "--batch-check=%(objectname)"], input=["HEAD"])))
+
+        calls = git_notifier.GitCalls
+        self.assertEquals(2, len(calls))
+        self.assertEquals(["rev-list", "HEAD"], calls[0].args)
+        self.assertEquals(41, calls[0].bytes)
+        self.assertEquals(0, calls[0].status)
+        self.assertTrue(calls[0].seconds >= 0)
+
+    def test_early_abort(self):
+        for i in range(20):
+            self.commit("commit %d" % i)
+
+        del git_notifier.GitCalls[:]
+        lines = git_notifier.gitStream(["log", "-p", "--", "file"])
+        lines.next()
+        lines.close()
+        self.assertNotEquals(None, git_notifier.GitCalls[0].status)
+
+class TestChangeMail(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.configure()
+        self.commit("one")
+        out = open("big", "w")
+        for i in range(5000):
+            print >>out, "line %d" % i
+        out.close()
+        self.run_git("add", "big")
+        self.run_git("commit", "-q", "-m", "big change")
+
+    def text(self, mail):
+        return mail.mime_text.get_payload()[-1].get_payload()
+
+    def test_small_diff(self):
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+        self.assertEquals(1, len(self.mails))
+        self.assertTrue("+line 4999" in self.text(self.mails[0]))
+        self.assertEquals(2, len(self.mails[0].mime_text.get_payload()))
+
+    def test_diff_suppressed(self):
+        git_notifier.Config.maxdiffsize = 1000
+        del git_notifier.GitCalls[:]
+
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+        text = self.text(self.mails[0])
+        self.assertTrue("Diff suppressed because of size" in text)
+        self.assertTrue("big | 5000 +" in text)
+        self.assertFalse("+line" in text)
+        self.assertEquals(1, len(self.mails[0].mime_text.get_payload()))
+
+        diffs = [call for call in git_notifier.GitCalls if call.args[0] == "diff-tree"]
+        self.assertEquals(2, len(diffs))
+        self.assertTrue(diffs[0].bytes < 10000)
+
+    def test_read_diff_limit(self):
+        diff_cmd = ["diff-tree", "--patch-with-stat", self.rev("HEAD")]
+        self.assertEquals(None, git_notifier.readDiff(diff_cmd, 1000))
+        self.assertTrue("+line 4999" in git_notifier.readDiff(diff_cmd, 1000000))
+
+class TestPerFileDiff(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.commit("one")
+
+        for (name, lines) in (("big", 5000), ("small", 3), ("gen.min.js", 3)):
+            out = open(name, "w")
+            for i in range(lines):
+                print >>out, "%s %d" % (name, i)
+            out.close()
+            self.run_git("add", name)
+
+        self.run_git("commit", "-q", "-m", "mixed change")
+
+    def text(self, mail):
+        return mail.mime_text.get_payload()[-1].get_payload()
+
+    def test_drop_large_and_generated(self):
+        self.configure("--maxfilediffsize=1000", "--generated=*.min.js")
+        del git_notifier.GitCalls[:]
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+
+        text = self.text(self.mails[0])
+        self.assertTrue("+small 2" in text)
+        self.assertFalse("+big" in text)
+        self.assertFalse("+gen.min.js" in text)
+        self.assertTrue("    big (too large)" in text)
+        self.assertTrue("    gen.min.js (generated)" in text)
+        self.assertEquals(2, len(self.mails[0].mime_text.get_payload()))
+
+        diffs = [call for call in git_notifier.GitCalls if call.args[0] == "diff-tree"]
+        self.assertTrue(all(call.bytes < 10000 for call in diffs))
+
+    def test_only_generated(self):
+        out = open("app.min.js", "w")
+        print >>out, "minified"
+        out.close()
+        self.run_git("add", "app.min.js")
+        self.run_git("commit", "-q", "-m", "generated")
+
+        self.configure("--generated=*.min.js")
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+
+        text = self.text(self.mails[0])
+        self.assertFalse("because of size" in text)
+        self.assertTrue("Diffs of all files left out" in text)
+        self.assertTrue("    app.min.js (generated)" in text)
+        self.assertTrue("app.min.js | 1 +" in text)
+
+    def test_attach_compressed(self):
+        self.configure("--inlinediffsize=2000")
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+
+        (html, text, attachment) = self.mails[0].mime_text.get_payload()
+        self.assertEquals("application/gzip", attachment.get_content_type())
+        self.assertTrue(attachment.get_filename().endswith(".patch.gz"))
+
+        patch = gzip.GzipFile(fileobj=StringIO(attachment.get_payload(decode=True))).read()
+        self.assertTrue("+big 4999" in patch and "+small 2" in patch)
+        self.assertTrue(" big " in text.get_payload())
+        self.assertFalse("+big" in text.get_payload() or "+big" in html.get_payload())
+        self.assertTrue("Diff shortened because of size" in text.get_payload())
+        self.assertTrue(len(str(self.mails[0])) < len(patch))
+
+    def test_numstat(self):
+        self.run_git("mv", "small", "renamed")
+        self.run_git("commit", "-q", "-m", "rename")
+        self.assertEquals([(0, 0, ["small", "renamed"])],
+                          git_notifier.diffNumstat(["diff-tree", "--patch-with-stat", "-M", self.rev("HEAD")]))
+
+class TestRenderCache(GitRepoTestCase):
+
+    def diff_calls(self):
+        return [call for call in git_notifier.GitCalls if call.args[0] == "diff-tree"]
+
+    def test_hit(self):
+        self.configure("--cachesize=1000000")
+        self.commit("zero")
+        rev = self.commit("one")
+        del git_notifier.GitCalls[:]
+
+        git_notifier.commit(git_notifier.State(), rev)
+        self.assertTrue(self.diff_calls())
+        del git_notifier.GitCalls[:]
+
+        git_notifier.commit(git_notifier.State(), rev, force=True, subject_head="other")
+        self.assertEquals([], self.diff_calls())
+
+        (first, second) = [mail.mime_text.get_payload() for mail in self.mails]
+        self.assertEquals(first[-1].get_payload(), second[-1].get_payload())
+        self.assertTrue("+one" in second[0].get_payload())
+        self.assertTrue("<h1>other: one" in second[0].get_payload())
+        self.assertTrue("other: one" in self.mails[1].mime_text["Subject"])
+
+    def test_eviction(self):
+        os.mkdir("cache")
+
+        for i in range(3):
+            # Left by earlier runs.
+            open(os.path.join("cache", str(i)), "w").write("100\n" + "x" * 100)
+            os.utime(os.path.join("cache", str(i)), (i, i))
+
+        cache = git_notifier.RenderCache("cache", 350)
+        self.assertEquals(("x" * 100, ""), cache.get("1"))
+
+        listdir = os.listdir
+        listings = []
+        os.listdir = lambda dir: listings.append(dir) or listdir(dir)
+
+        try:
+            cache.put("3", "y" * 100, "<b>")
+            self.assertEquals(None, cache.get("0"))
+            self.assertEquals(("x" * 100, ""), cache.get("2"))
+            cache.put("4", "z" * 100, "")
+        finally:
+            os.listdir = listdir
+
+        self.assertEquals(None, cache.get("1"))
+        self.assertEquals(("x" * 100, ""), cache.get("2"))
+        self.assertEquals(("y" * 100, "<b>"), cache.get("3"))
+        self.assertEquals(["2", "3", "4"], sorted(os.listdir("cache")))
+        self.assertEquals(1, len(listings))
+
+    def test_disabled(self):
+        cache = git_notifier.RenderCache("cache", 0)
+        cache.put("key", "text", "")
+        self.assertEquals(None, cache.get("key"))
+        self.assertFalse(os.path.exists("cache"))
+
+class TestDigest(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.commit("zero")
+        self.revs = [self.commit("change %d" % i) for i in range(5)]
+
+    def test_digest(self):
+        self.configure("--digest=3")
+        current = git_notifier.State()
+        git_notifier.reportPath(current, self.revs)
+
+        self.assertEquals(1, len(self.mails))
+        self.assertEquals("[git] master: 5 new revisions", self.mails[0].mime_text["Subject"])
+        text = self.mails[0].mime_text.get_payload()[0].get_payload()
+        self.assertTrue(all(("change %d" % i) in text for i in range(5)))
+        self.assertEquals(5, text.count("1 file changed, 1 insertion(+)"))
+        self.assertEquals(set(self.revs), current.reported)
+
+    def test_split(self):
+        self.configure("--digest=3")
+        git_notifier.DigestMailSize = 2
+        try:
+            git_notifier.reportPath(git_notifier.State(), self.revs)
+        finally:
+            git_notifier.DigestMailSize = 1000
+
+        self.assertEquals(["(1/3)", "(2/3)", "(3/3)"], [mail.mime_text["Subject"].split()[-1] for mail in self.mails])
+
+    def test_below_threshold(self):
+        self.configure("--digest=5")
+        git_notifier.reportPath(git_notifier.State(), self.revs)
+        self.assertEquals(5, len(self.mails))
+
+class TestLargeSets(GitRepoTestCase):
+    """ Runs with the argument space of git children cut down to 256K, which
+    the revisions and refs used here exceed. """
+
+    Count = 10000
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.rlimit = resource.getrlimit(resource.RLIMIT_STACK)
+        resource.setrlimit(resource.RLIMIT_STACK, (1024 * 1024, self.rlimit[1]))
+
+    def tearDown(self):
+        resource.setrlimit(resource.RLIMIT_STACK, self.rlimit)
+        GitRepoTestCase.tearDown(self)
+
+    def fast_import(self, tags):
+        cmds = []
+
+        for i in range(1, self.Count + 1):
+            cmds.append("commit refs/heads/master\nmark :%d\n" % i)
+            cmds.append("committer Test <test@example.com> %d +0000\n" % (1300000000 + i))
+            cmds.append("data %d\ncommit %05d\n" % (len("commit %05d\n" % i), i))
+
+            if tags:
+                cmds.append("tag t%d\nfrom :%d\ntagger Test <test@example.com> 1300000000 +0000\ndata 0\n" % (i, i))
+
+        child = subprocess.Popen(["git", "fast-import", "--quiet"], stdin=subprocess.PIPE)
+        child.communicate("".join(cmds))
+        self.assertEquals(0, child.returncode)
+
+    def test_many_refs(self):
+        self.fast_import(tags=True)
+        cache = git_notifier.State.getCurrent()
+        self.assertEquals(self.Count, len(cache.tags))
+        self.assertEquals(self.Count, len(cache.revs))
+
+        self.commit("one more")
+        current = git_notifier.State.getIncremental(cache, [(cache.heads["master"], self.rev("HEAD"), "refs/heads/master")])
+        self.assertEquals(set([self.rev("HEAD")]), current.added)
+
+        git_notifier.Branches.build(cache, current, current.added)
+        self.assertEquals(["master"], git_notifier.Branches.lookup(self.rev("HEAD")))
+
+    def test_many_revs(self):
+        self.fast_import(tags=False)
+        self.configure("--digest=%d" % (self.Count - 1))
+        current = git_notifier.State()
+        revs = self.run_git("rev-list", "HEAD").split()
+        git_notifier.reportPath(current, revs)
+
+        self.assertEquals(self.Count, len(current.reported))
+        self.assertEquals(self.Count // git_notifier.DigestMailSize, len(self.mails))
+        text = self.mails[0].mime_text.get_payload()[0].get_payload()
+        self.assertTrue(text.index("commit 00001") < text.index("commit 01000"))
+
+    def write_files(self, pattern, count):
+        for i in range(count):
+            name = pattern % i
+            os.makedirs(os.path.dirname(name))
+            open(name, "w").write("%s\n" % name)
+
+    def test_many_generated(self):
+        self.commit("one")
+        self.write_files("node_modules/package-%05d/dist/index.min.js", self.Count // 2)
+        self.run_git("add", "node_modules")
+        self.commit("real change")
+
+        self.configure("--generated=node_modules/*")
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+
+        text = self.mails[0].mime_text.get_payload()[-1].get_payload()
+        self.assertTrue("+real change" in text)
+        self.assertFalse("+node_modules" in text)
+        self.assertTrue("    node_modules/package-00000/dist/index.min.js (generated)" in text)
+
+    def test_many_generated_and_kept(self):
+        self.commit("one")
+        self.write_files("node_modules/package-%05d/dist/index.min.js", self.Count // 2)
+        self.write_files("src/module-%05d/lib/index.js", self.Count // 2)
+        self.run_git("add", "node_modules", "src")
+        self.run_git("commit", "-q", "-m", "vendored")
+
+        self.configure("--generated=node_modules/*", "--maxdiffsize=100000000")
+        git_notifier.commit(git_notifier.State(), self.rev("HEAD"))
+
+        text = self.mails[0].mime_text.get_payload()[-1].get_payload()
+        self.assertTrue("Diff suppressed because of size" in text)
+        self.assertTrue("src/module-00000/lib/index.js" in text)
+        self.assertFalse("+src" in text)
+
+class TestSpool(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.configure("--incremental")
+        (self.mailer, self.backoff) = (git_notifier.mailer, git_notifier.SpoolBackoff)
+        git_notifier.mailer = git_notifier.Mailer("localhost", 25, "sender", "", ["recipient"])
+        git_notifier.SpoolBackoff = 0
+        self.commit("one")
+        git_notifier.processUpdates()
+
+    def tearDown(self):
+        (git_notifier.mailer, git_notifier.SpoolBackoff) = (self.mailer, self.backoff)
+        GitRepoTestCase.tearDown(self)
+
+    def push(self, msg):
+        old = self.rev("HEAD")
+        new = self.commit(msg)
+        git_notifier.spoolUpdates([(old, new, "refs/heads/master")])
+        return new
+
+    def subjects(self):
+        return [mail.mime_text["Subject"] for mail in self.mails]
+
+    def test_deliver_in_order(self):
+        self.push("two")
+        self.push("three")
+        self.assertEquals(2, len(git_notifier.spoolEntries()))
+        self.assertEquals([], self.mails)
+
+        git_notifier.deliverSpool()
+        self.assertEquals([], git_notifier.spoolEntries())
+        self.assertEquals(2, len(self.mails))
+        self.assertTrue("two" in self.subjects()[0])
+        self.assertTrue("three" in self.subjects()[1])
+
+        cache = git_notifier.State()
+        cache.readFrom(git_notifier.CacheFile)
+        self.assertEquals(self.rev("HEAD"), cache.heads["master"])
+
+    def test_retry(self):
+        self.push("two")
+        failures = [1]
+
+        def send(mail):
+            if failures:
+                failures.pop()
+                raise git_notifier.smtplib.SMTPServerDisconnected("gone")
+            self.mails.append(mail)
+
+        git_notifier.sendMail = send
+        git_notifier.deliverSpool()
+        self.assertEquals([], git_notifier.spoolEntries())
+        self.assertEquals(1, len(self.mails))
+
+    def test_give_up(self):
+        self.push("two")
+        data = open(git_notifier.CacheFile, "rb").read()
+        open(git_notifier.CacheFile, "wb").write(data[:-10]) # Makes error() exit.
+        git_notifier.deliverSpool()
+
+        self.assertEquals([], git_notifier.spoolEntries())
+        self.assertEquals(1, len([entry for entry in os.listdir(git_notifier.SpoolDir) if entry.endswith(".failed")]))
+        self.assertEquals([], self.mails)
+
+    def test_user(self):
+        out = open("users", "w")
+        print >>out, "alice Alice <alice@example.com>"
+        out.close()
+        git_notifier.Config.users = "users"
+
+        old = self.rev("HEAD")
+        new = self.commit("two")
+        git_notifier.spoolUpdates([(old, new, "refs/heads/master")], user="alice")
+        git_notifier.deliverSpool()
+        self.assertEquals("Alice <alice@example.com>", self.mails[0].mime_text["From"])
+
+class SMTPSink(smtpd.SMTPServer):
+    """ Local SMTP server collecting the mails it gets. """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+
+        thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
+
+class TestDaemon(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.sink = SMTPSink()
+        self.run_git("config", "hooks.smtp-host", "127.0.0.1")
+        self.run_git("config", "hooks.smtp-port", str(self.sink.port))
+        self.run_git("config", "hooks.mailinglist", "list@example.com")
+        self.commit("one")
+
+        self.socket = os.path.join(self.dir, "socket")
+        script = os.path.join(self.cwd, "git_notifier.py")
+        self.daemon = subprocess.Popen([sys.executable, script, "--daemon", self.socket, "--log", "daemon.log"])
+        self.wait(lambda: os.path.exists(self.socket))
+
+    def tearDown(self):
+        self.daemon.kill()
+        self.daemon.wait()
+        self.sink.close()
+        GitRepoTestCase.tearDown(self)
+
+    def wait(self, done):
+        for i in range(300):
+            if done():
+                return
+
+            time.sleep(0.05)
+
+        self.fail("timed out")
+
+    def push(self, old, new, *args):
+        client = os.path.join(self.cwd, "git-notifier-client")
+        child = subprocess.Popen([sys.executable, client, self.socket] + list(args), cwd=".git",
+                                 stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = child.communicate("%s %s refs/heads/master\n" % (old, new))
+        return (child.returncode, err)
+
+    def test_push(self):
+        self.assertEquals((0, ""), self.push(git_notifier.ZeroRev, self.rev("HEAD"), "--incremental"))
+        self.wait(lambda: os.path.exists(os.path.join(".git", git_notifier.CacheFile)))
+
+        old = self.rev("HEAD")
+        self.commit("two")
+        self.assertEquals((0, ""), self.push(old, self.rev("HEAD"), "--incremental"))
+        self.wait(lambda: self.sink.messages)
+        self.assertTrue("master: two" in self.sink.messages[0])
+
+    def test_options_per_push(self):
+        self.assertEquals((0, ""), self.push(git_notifier.ZeroRev, self.rev("HEAD"), "--incremental"))
+        self.wait(lambda: os.path.exists(os.path.join(".git", git_notifier.CacheFile)))
+
+        for (msg, prefix) in (("two", "[first]"), ("three", "[second]")):
+            old = self.rev("HEAD")
+            self.commit(msg)
+            self.assertEquals((0, ""), self.push(old, self.rev("HEAD"), "--incremental", "--emailprefix", prefix))
+
+        self.wait(lambda: len(self.sink.messages) == 2)
+        self.assertTrue("[first] master: two" in self.sink.messages[0])
+        self.assertTrue("[second] master: three" in self.sink.messages[1])
+
+    def test_push_after_idle_stop(self):
+        idle = git_notifier.DaemonIdle
+        git_notifier.DaemonIdle = 0
+        repo = os.path.join(self.dir, ".git")
+        args = ["--incremental", "--log", "worker.log"]
+        workers = {}
+        first = None
+
+        try:
+            git_notifier.spoolUpdates([(git_notifier.ZeroRev, self.rev("HEAD"), "refs/heads/master")],
+                                      args=args, dir=os.path.join(repo, git_notifier.SpoolDir))
+            git_notifier.handOff(workers, repo, [])
+            first = workers[repo]
+            self.wait(lambda: os.path.exists(os.path.join(repo, git_notifier.CacheFile)))
+
+            time.sleep(0.01)
+            git_notifier.reapWorkers(workers)
+            self.assertEquals({}, workers)
+
+            old = self.rev("HEAD")
+            self.commit("two")
+            git_notifier.spoolUpdates([(old, self.rev("HEAD"), "refs/heads/master")],
+                                      args=args, dir=os.path.join(repo, git_notifier.SpoolDir))
+            git_notifier.handOff(workers, repo, [])
+            self.assertNotEquals(first.pid, workers[repo].pid)
+
+            self.wait(lambda: self.sink.messages)
+            self.assertTrue("master: two" in self.sink.messages[0])
+
+        finally:
+            git_notifier.DaemonIdle = idle
+
+            for worker in workers.values():
+                worker.stop()
+
+            for worker in filter(None, [first] + workers.values()):
+                try:
+                    os.waitpid(worker.pid, 0)
+                except OSError:
+                    pass
+
+    def test_bad_request(self):
+        os.mkdir("elsewhere")
+        os.chdir("elsewhere")
+        os.mkdir(".git")
+        (status, err) = self.push(git_notifier.ZeroRev, git_notifier.ZeroRev)
+        self.assertEquals(1, status)
+        self.assertTrue("not a repository" in err)
+
+class TestRouteTrie(unittest.TestCase):
+
+    def test_match(self):
+        trie = git_notifier.RouteTrie()
+        trie.add("src/net/", ["net@example.com"])
+        trie.add("src", ["src@example.com"])
+        trie.add("docs/*.rst", ["docs@example.com"])
+        trie.add("*.c", ["c@example.com"])
+
+        self.assertEquals(set(["net@example.com", "src@example.com"]), trie.match("src/net/x.h"))
+        self.assertEquals(set(["src@example.com"]), trie.match("src/network/x.h"))
+        self.assertEquals(set(["src@example.com", "c@example.com"]), trie.match("src/a/b.c"))
+        self.assertEquals(set(["docs@example.com"]), trie.match("docs/sub/x.rst"))
+        self.assertEquals(set(), trie.match("docs/x.txt"))
+        self.assertEquals(set(), trie.match("srcx"))
+
+class TestRoutes(GitRepoTestCase):
+
+    def test_routes(self):
+        out = open("routes", "w")
+        print >>out, "# Teams."
+        print >>out, "net/ net@example.com"
+        print >>out, "docs/*.rst docs@example.com, editor@example.com"
+        out.close()
+
+        os.mkdir("net")
+        os.mkdir("docs")
+        self.commit("zero")
+        self.configure("--routes", "routes", "--mailinglist", "list@example.com")
+        git_notifier.processUpdates()
+
+        self.commit("net", "net/socket.c")
+        self.commit("docs", "docs/index.rst")
+        self.commit("other", "other")
+        out = open("net/socket.c", "a")
+        print >>out, "more"
+        out.close()
+        self.run_git("add", "net/socket.c")
+        self.commit("both", "docs/index.rst")
+
+        del git_notifier.GitCalls[:]
+        git_notifier.processUpdates()
+
+        recipients = dict((mail.mime_text["Subject"].split()[2], mail.mime_text["To"]) for mail in self.mails)
+        self.assertEquals({"net": "net@example.com",
+                           "docs": "docs@example.com, editor@example.com",
+                           "other": "list@example.com",
+                           "both": "docs@example.com, editor@example.com, net@example.com"}, recipients)
+
+        calls = [call for call in git_notifier.GitCalls if "--name-only" in call.args]
+        self.assertEquals(1, len(calls))
+
+    def test_merge(self):
+        out = open("routes", "w")
+        print >>out, "side side@example.com"
+        print >>out, "main main@example.com"
+        out.close()
+
+        self.commit("zero")
+        self.configure("--routes", "routes", "--mailinglist", "list@example.com")
+        git_notifier.processUpdates()
+
+        self.run_git("checkout", "-q", "-b", "topic")
+        self.commit("side", "side")
+        self.run_git("checkout", "-q", "master")
+        self.commit("main", "main")
+        self.run_git("merge", "-q", "--no-edit", "topic")
+        merge = self.rev("HEAD")
+
+        self.assertEquals(["side"], git_notifier.Objects.paths(merge))
+        self.assertEquals("side@example.com", git_notifier.routeRecipients(merge))
+
+class TestMetrics(GitRepoTestCase):
+
+    def setUp(self):
+        GitRepoTestCase.setUp(self)
+        self.run_git("config", "hooks.smtp-host", "127.0.0.1")
+        self.run_git("config", "hooks.mailinglist", "list@example.com")
+        self.commit("one")
+
+    def run_hook(self, *args):
+        script = os.path.join(self.cwd, "git_notifier.py")
+        subprocess.check_output([sys.executable, script, "--debug"] + list(args), stderr=open(os.devnull, "w"))
+
+    def test_phases(self):
+        self.run_hook("--metrics", "metrics.json")
+        self.commit("two")
+        self.run_hook("--metrics", "metrics.json", "--profile", "profile.txt")
+
+        runs = [json.loads(line) for line in open("metrics.json")]
+        self.assertEquals(2, len(runs))
+        self.assertEquals(set(["config", "state.current"]), set(runs[0]["phases"]))
+
+        phases = runs[1]["phases"]
+        self.assertEquals(set(["config", "state.read", "state.current", "refs.diff", "commit", "html", "mime"]),
+                          set(phases))
+        self.assertEquals(1, phases["commit"]["count"])
+        self.assertTrue(phases["commit"]["git_calls"] > 0)
+        self.assertTrue(phases["html"]["bytes"] > 0)
+        self.assertTrue(phases["mime"]["bytes"] > phases["html"]["bytes"])
+        self.assertTrue(runs[1]["git_calls"] >= phases["commit"]["git_calls"] + phases["state.current"]["git_calls"])
+        self.assertTrue("cumulative" in open("profile.txt").read())
+
+    def test_nested(self):
+        with git_notifier.phase("outer"):
+            with git_notifier.phase("inner"):
+                git_notifier.git(["rev-parse", "HEAD"])
+
+        self.assertEquals(1, git_notifier.Phases["outer"].calls)
+        self.assertEquals(41, git_notifier.Phases["inner"].git_bytes)
+        self.assertEquals([], git_notifier.ActivePhases)
+
+        git_notifier.writeMetrics(time.time())
+        self.assertEquals({}, git_notifier.Phases)
+
+class TestParallelRendering(GitRepoTestCase):
+
+    def report(self, *args):
+        self.configure(*args)
+        current = git_notifier.State()
+        git_notifier.reportPath(current, self.revs)
+        return [(mail.mime_text["Subject"], mail.mime_text.get_payload()[-1].get_payload()) for mail in self.mails]
+
+    def test_same_mails_in_same_order(self):
+        self.revs = [self.commit("change %d" % i, fname="file%d" % (i % 3)) for i in range(8)]
+        self.run_git("commit", "-q", "--allow-empty", "-m", "skip me [nomail]")
+        self.revs.append(self.rev("HEAD"))
+
+        serial = self.report()
+        self.assertEquals(8, len(serial))
+        self.assertEquals(serial, self.report("--parallel=4"))